@@ -17,10 +17,10 @@ import matplotlib
 import matplotlib.pyplot as plt
 # matplotlib.use('TkAgg')
 matplotlib.use('Agg')
-from scipy.signal import butter, sosfilt
 import getpass
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..')))
 from GetEvent import GetEvent
+from ana import FilterBank
 
 class Analysis(tk.Frame):
      def __init__(self, master=None):
@@ -286,18 +286,10 @@ class Analysis(tk.Frame):
         fhat = indices * self.fhat                                         # Zero out small Fourier coeffs. in Y
         self.ffilt = ( np.fft.ifft(fhat) ).real                       # Inserse FFT for filtered time signal  
      
-        # Use butter to filter frequency
-        lowcut = float(self.freq_cutoff_low_entry.get())
-        highcut = float(self.freq_cutoff_high_entry.get())
-        nyq = len(self.ffilt)/(self.t[-1]-self.t[0])/2.0
-        low = lowcut / nyq
-        high = highcut / nyq
-        if low <= 0:
-            low = 0.0001
-        if high >= 1:
-            high = 0.9999
-        sos = butter(6, [low, high], analog=False, btype='band', output='sos')
-        self.ffilt = sosfilt(sos, self.ffilt)        
+        # Use butter to filter frequency, with the filter from the shared filter bank at the recorded sample rate
+        fs = self.fastDAQ_event['acoustics']['sample_rate']
+        band = FilterBank.ClipBand([float(self.freq_cutoff_low_entry.get()), float(self.freq_cutoff_high_entry.get())], fs)
+        self.ffilt = FilterBank.Filter(self.ffilt, 6, band, fs, zero_phase=False)
 
      def denoise_signal_fft(self):
         # Use of PSD to filter out freq
@@ -15,6 +15,7 @@ from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from PIL import Image, ImageTk
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..')))
 from GetEvent import GetEvent
+from ana import FilterBank
 
 
 class Piezo(tk.Frame):
@@ -28,6 +29,7 @@ class Piezo(tk.Frame):
         self.piezo_ending_time = 0.0
         self.incremented_piezo_event = False
         self.piezo_timerange_checkbutton_var = tk.BooleanVar(value=False)
+        self.piezo_filter_checkbutton_var = tk.BooleanVar(value=False)
         self.t0 = None
 
         # Initial Functions
@@ -116,19 +118,13 @@ class Piezo(tk.Frame):
             wf_key = "Waveforms" if "Waveforms" in self.fastDAQ_event["acoustics"] else "Waveform"
             piezo_v = self.fastDAQ_event['acoustics'][wf_key][0][self.piezo_combobox.current()]
             piezo_time = np.arange(len(piezo_v)) * (1 / self.fastDAQ_event['acoustics']['sample_rate'])
-            fn = len(piezo_v)/(piezo_time[-1]-piezo_time[0])/2
-            # if (self.piezo_cutoff_high / fn) > 1:
-            #     self.logger.error('Cutoff freq > Nyquist, setting = Nyquist')
-            #     self.piezo_cutoff_high = int(fn)
-            #     self.piezo_cutoff_high_entry.delete(0,tk.END)
-            #     self.piezo_cutoff_high_entry.insert(0,self.piezo_cutoff_high)
-                
-            # b, a = scipy.signal.butter(3, self.piezo_cutoff_high / fn)
-            # filtered_piezo_v = scipy.signal.lfilter(b, a, piezo_v)
-            # b, a = scipy.signal.butter(3, self.piezo_cutoff_low / fn, 'high')
-            # filtered_piezo_v = scipy.signal.lfilter(b, a, filtered_piezo_v)
-
+            # The raw trace unless filtering is turned on. Then band-pass between the cutoffs, with the filter
+            # from the shared filter bank at the recorded sample rate
             filtered_piezo_v = piezo_v
+            if self.piezo_filter_checkbutton_var.get():
+                fs = self.fastDAQ_event['acoustics']['sample_rate']
+                band = FilterBank.ClipBand([self.piezo_cutoff_low, self.piezo_cutoff_high], fs)
+                filtered_piezo_v = FilterBank.Filter(piezo_v, 3, band, fs, zero_phase=False)
 
             # Set Plot Labels
             self.piezo_ax.clear()
@@ -279,9 +275,16 @@ class Piezo(tk.Frame):
             command=self.draw_fastDAQ_piezo)
         self.piezo_plot_t0_checkbutton.grid(row=7, column=0, columnspan=2, sticky='WE')
 
+        self.piezo_filter_checkbutton = tk.Checkbutton(
+            self.piezo_tab_left,
+            text='Band-pass filter',
+            variable=self.piezo_filter_checkbutton_var,
+            command=self.draw_fastDAQ_piezo)
+        self.piezo_filter_checkbutton.grid(row=8, column=0, columnspan=2, sticky='WE')
+
         self.reload_fastDAQ_piezo_button = tk.Button(self.piezo_tab_left, text='reload',
                                                      command=self.draw_fastDAQ_piezo)
-        self.reload_fastDAQ_piezo_button.grid(row=8, column=0, sticky='WE')
+        self.reload_fastDAQ_piezo_button.grid(row=9, column=0, sticky='WE')
 
     def piezo_error(self):
         print(f"No acoustics.sbc for {self.run} - {self.event}")
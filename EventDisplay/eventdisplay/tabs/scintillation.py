@@ -11,6 +11,7 @@ from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 # Hacky
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..')))
 from GetEvent import GetEvent, GetScint
+from ana.ADCCalibration import GetCalibration
 # Even more hacky
 BASE = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
 ANA_DIR = os.path.join(BASE, 'ana')
@@ -75,6 +76,15 @@ class Scintillation(tk.Frame):
     def load_event(self):
         selected = ["run_control", "scintillation", "event_info"]
         self.scint_fastdaq_event = GetEvent(self.path, self.event, *selected, lazy_load_scintillation=False)
+        # Cached per run, used to draw the waveforms in mV
+        self.calibration = GetCalibration(self.scint_fastdaq_event.get("run_control"))
+
+    # Waveform of one channel for the current trigger, in mV if the run has a calibration
+    def channel_waveform(self, idx):
+        data = self.scint_fastdaq_event['scintillation']['Waveforms'][self.trigger_index][idx]
+        if self.calibration is None:
+            return data
+        return self.calibration.convert(data, idx)
 
     # Create channel names in listbox
     def populate_channel_listbox(self):
@@ -167,13 +177,12 @@ class Scintillation(tk.Frame):
     # Waveform settings and logic
     def update_waveform_settings(self, idx):
         # Pull waveforms for a trigger across only selected channels
-        waveforms = self.scint_fastdaq_event['scintillation']['Waveforms'][self.trigger_index]
         selected_channels = self.scintillation_listbox.curselection()
         if not selected_channels:
             selected_channels = [0]
-        all_selected_data = np.array([waveforms[idx] for idx in selected_channels])
+        all_selected_data = np.array([self.channel_waveform(idx) for idx in selected_channels])
         # Pull sampling rate and triggers
-        self.data = self.scint_fastdaq_event['scintillation']['Waveforms'][self.trigger_index][idx]
+        self.data = self.channel_waveform(idx)
         self.time = np.arange(len(self.data)) * (1 / self.scint_fastdaq_event['scintillation']['sample_rate'])
         num_trigs = self.scint_fastdaq_event['scintillation']['Waveforms'].shape[0]
         self.trigger_count_label.config(text=f"Triggers: {num_trigs}")
@@ -282,7 +291,7 @@ class Scintillation(tk.Frame):
 
 
         for idx in selections:
-            data = self.scint_fastdaq_event['scintillation']['Waveforms'][self.trigger_index][idx]
+            data = self.channel_waveform(idx)
             time = np.arange(len(data)) * (1 / self.scint_fastdaq_event['scintillation']['sample_rate'])
 
             filtered = self.filter_signal_by_freq(data, self.f_low_var.get(), self.f_high_var.get())
@@ -292,7 +301,7 @@ class Scintillation(tk.Frame):
             vmins.append(np.min(data))
             vmaxs.append(np.max(data))
 
-            data = self.scint_fastdaq_event['scintillation']['Waveforms'][self.trigger_index][idx]
+            data = self.channel_waveform(idx)
             sample_rate = self.scint_fastdaq_event['scintillation']['sample_rate']
             dt = 1 / sample_rate
 
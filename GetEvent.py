@@ -1,11 +1,16 @@
 import os
 import numpy as np
-from sbcbinaryformat import Streamer, TarStreamer, Writer
+from sbcbinaryformat import Streamer, Writer
 from PIL import Image
 import json
 import warnings
 import tarfile
+import threading
+import hashlib
 import io
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 full_loadlist = [
     "acoustics",
@@ -18,75 +23,344 @@ full_loadlist = [
     "run_control"
 ]
 
+# keys of event["scintillation"] that are not (lazily loaded) data columns
+scint_helper_keys = ["loaded", "length", "sample_rate", "EventCounter"]
+
 def GetScint(ev, start=None, end=None, length=None):
     out_ev = dict([(k, v.copy()) for (k, v) in ev.items()]) # copy input
 
     for key in ev["scintillation"].keys():
-        if key == "loaded" or key == "length" or key == "sample_rate" or key == "EventCounter": # skip helper keys
+        if key in scint_helper_keys: # skip helper keys
             continue
 
         out_ev["scintillation"][key] = ev["scintillation"][key](start=start, end=end, length=length)
 
     return out_ev
 
+# Sidecar member index for tar runs. Written next to the tar if possible, otherwise in the cache directory
+INDEX_VERSION = 1
+INDEX_SUFFIX = ".index.json"
+INDEX_CACHE_DIR = os.environ.get("SBC_INDEX_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "sbc_tar_index"))
+
+class MemberFile(io.RawIOBase):
+    # Read-only, seekable file object over one member of an indexed tar, so that streamers read
+    # the member in place through RunArchive instead of scanning the tar for it
+    def __init__(self, archive, offset, size):
+        self.archive = archive
+        self.offset = offset
+        self.size = size
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self.pos
+        elif whence == io.SEEK_END:
+            pos += self.size
+        if pos < 0:
+            raise ValueError("Negative seek position %i" % pos)
+        self.pos = pos
+        return self.pos
+
+    def readinto(self, b):
+        n = max(min(len(b), self.size - self.pos), 0)
+        if n == 0:
+            return 0
+        data = self.archive.pread(self.offset + self.pos, n)
+        b[:n] = data
+        self.pos += n
+        return n
+
+class RunArchive:
+    # Handle on a run, either a directory or a .tar file. For tar files, the archive is
+    # scanned once on construction and each member is indexed by name -> (data offset, size, mtime),
+    # so later lookups and reads seek directly into the file instead of rescanning the tar.
+    # The index is saved to a sidecar file (see INDEX_SUFFIX, INDEX_CACHE_DIR) and reused by
+    # later opens as long as the tar size and mtime still match.
+    def __init__(self, rundirectory):
+        if os.path.isdir(rundirectory):
+            self.is_tar = False
+        elif rundirectory.endswith(".tar"):
+            self.is_tar = True
+        else:
+            raise ValueError("Input rundirectory (%s) must either be a directory or a tar file (.tar)" % rundirectory)
+
+        self.path = rundirectory
+        self.name = os.path.splitext(os.path.basename(rundirectory))[0]
+        self.members = {}
+        self.event_files = {}
+        self.ndir = 0
+        self._fh = None
+        self._lock = threading.Lock()
+
+        if self.is_tar:
+            stat = os.stat(rundirectory)
+            self._stat = (stat.st_size, stat.st_mtime_ns)
+            self._build_index()
+            self._open()
+
+    def _open(self):
+        self._fh = open(self.path, "rb")
+        self._pid = os.getpid()
+
+    def _build_index(self):
+        # Use the sidecar index if one matches this tar, otherwise scan the tar headers and save one
+        if self._load_index():
+            return
+
+        with tarfile.open(self.path, "r") as tf:
+            for m in tf:
+                if m.isdir():
+                    self.ndir += 1
+                elif m.isfile():
+                    self._add_member(m.name, m.offset_data, m.size, m.mtime)
+
+        self._save_index()
+
+    def _add_member(self, name, offset, size, mtime):
+        self.members[name] = (offset, size, mtime)
+        if size > 0:
+            dirname, fname = name.rsplit("/", 1) if "/" in name else ("", name)
+            self.event_files.setdefault(dirname, []).append(fname)
+
+    def _index_files(self):
+        # Candidate sidecar locations: next to the tar, then in the index cache directory
+        cache_name = "%s-%s.json" % (self.name, hashlib.sha1(os.path.abspath(self.path).encode()).hexdigest()[:12])
+        return [self.path + INDEX_SUFFIX, os.path.join(INDEX_CACHE_DIR, cache_name)]
+
+    def _load_index(self):
+        for index_file in self._index_files():
+            try:
+                with open(index_file, "r") as f:
+                    index = json.load(f)
+            except (OSError, ValueError):
+                continue
+
+            # never trust an index written for a different version of the tar
+            if index.get("version") != INDEX_VERSION or (index.get("tar_size"), index.get("tar_mtime_ns")) != self._stat:
+                continue
+
+            self.ndir = index["ndir"]
+            for name, offset, size, mtime in index["members"]:
+                self._add_member(name, offset, size, mtime)
+            return True
+
+        return False
+
+    def _save_index(self):
+        index = dict(
+            version=INDEX_VERSION,
+            tar_size=self._stat[0],
+            tar_mtime_ns=self._stat[1],
+            ndir=self.ndir,
+            members=[[name, *m] for name, m in self.members.items()],
+        )
+        for index_file in self._index_files():
+            tmp_file = "%s.%i.tmp" % (index_file, os.getpid())
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(index_file)), exist_ok=True)
+                with open(tmp_file, "w") as f:
+                    json.dump(index, f, separators=(",", ":"))
+                os.replace(tmp_file, index_file) # atomic, so concurrent readers never see a partial index
+                return
+            except OSError:
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+                continue
+
+    def stale(self):
+        # True if the tar file changed on disk since it was indexed
+        if not self.is_tar:
+            return False
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return True
+        return (stat.st_size, stat.st_mtime_ns) != self._stat
+
+    def event_dir(self, ev):
+        return os.path.join(self.name if self.is_tar else self.path, str(ev))
+
+    def base_dir(self):
+        return self.name if self.is_tar else self.path
+
+    def nevent(self):
+        if not self.is_tar:
+            return len([d for d in os.listdir(self.path) if os.path.isdir(os.path.join(self.path, d))])
+        return self.ndir
+
+    def files(self, event_dir):
+        if not self.is_tar:
+            files = []
+            for fname in os.listdir(event_dir):
+                fpath = os.path.join(event_dir, fname)
+                if os.path.isfile(fpath) and os.path.getsize(fpath) > 0:
+                    files.append(fname)
+            return files
+        return list(self.event_files.get(event_dir, []))
+
+    def exists(self, file_name):
+        if not self.is_tar:
+            if not os.path.exists(file_name):
+                return False
+            return os.path.getsize(file_name) > 0
+        return file_name in self.members and self.members[file_name][1] > 0
+
+    def read(self, file_name):
+        # Returns the full contents of a file in the run as bytes
+        if not self.is_tar:
+            with open(file_name, "rb") as f:
+                return f.read()
+        offset, size, _ = self.members[file_name]
+        return self.pread(offset, size)
+
+    def pread(self, offset, size):
+        # Returns size bytes of the tar file starting at offset
+        if hasattr(os, "pread"):
+            # pread leaves the file offset alone, so reads are safe from several threads and from forked
+            # processes, which share the offset of the inherited handle
+            chunks = []
+            while size > 0:
+                chunk = os.pread(self._fh.fileno(), size, offset)
+                if not chunk:
+                    raise EOFError("Unexpected end of %s reading %i bytes at %i" % (self.path, size, offset))
+                chunks.append(chunk)
+                offset += len(chunk)
+                size -= len(chunk)
+            return b"".join(chunks)
+        with self._lock:
+            if self._pid != os.getpid(): # forked: get a handle with an offset of our own
+                self._open()
+            self._fh.seek(offset)
+            return self._fh.read(size)
+
+    def open(self, file_name):
+        return io.BytesIO(self.read(file_name))
+
+    def streamer(self, file_name, **kwargs):
+        # Streamer over an .sbc file of the run. Members of a tar are read in place through the index
+        if not self.is_tar:
+            return Streamer(file_name, **kwargs)
+        offset, size, _ = self.members[file_name]
+        return Streamer(io.BufferedReader(MemberFile(self, offset, size)), **kwargs)
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def __del__(self):
+        self.close()
+
+# Recently opened runs, so that repeated GetEvent/NEvent calls on the same run share one handle
+MAX_OPEN_RUNS = 8
+_open_runs = {}
+
+def OpenRun(rundirectory):
+    if isinstance(rundirectory, RunArchive):
+        return rundirectory
+
+    key = os.path.abspath(rundirectory)
+    run = _open_runs.pop(key, None)
+    if run is None or run.stale():
+        run = RunArchive(rundirectory)
+    _open_runs[key] = run # (re)insert as most recently used
+
+    while len(_open_runs) > MAX_OPEN_RUNS:
+        del _open_runs[next(iter(_open_runs))]
+
+    return run
+
 def NEvent(rundirectory):
-    if os.path.isdir(rundirectory):
-        return len([d for d in os.listdir(rundirectory) if os.path.isdir(os.path.join(rundirectory, d))])
-    elif rundirectory.endswith(".tar"):
-        with tarfile.open(rundirectory, "r") as tf:
-            return sum([m.isdir() for m in tf.getmembers()]) 
-    else:
-        raise ValueError("Input rundirectory (%s) must either be a directory or a tar file (.tar)" % rundirectory)
+    return OpenRun(rundirectory).nevent()
 
 def GetFiles(rundirectory, event_dir):
-    if os.path.isdir(rundirectory):
-        files = []
-        for fname in os.listdir(event_dir):
-            fpath = os.path.join(event_dir, fname)
-            if os.path.isfile(fpath) and os.path.getsize(fpath) > 0:
-                files.append(fname)
-        return files
-    elif rundirectory.endswith(".tar"):
-        with tarfile.open(rundirectory, "r") as tf:
-            return [m.name.split("/")[-1] for m in tf.getmembers() 
-                    if m.name.startswith(event_dir + "/") and m.isfile() and m.size > 0]
-    else:
-        raise ValueError("Input rundirectory (%s) must either be a directory or a tar file (.tar)" % rundirectory)
+    return OpenRun(rundirectory).files(event_dir)
 
 def FileExists(rundirectory, file_name):
-    if os.path.isdir(rundirectory):
-        if not os.path.exists(file_name):
-            return False
-        return os.path.getsize(file_name) > 0
-    elif rundirectory.endswith(".tar"):
-        with tarfile.open(rundirectory, "r") as tf:
-            if file_name not in tf.getnames():
-                return False
-            member = tf.getmember(file_name)
-            return member.size > 0
-    else:
-        raise ValueError("Input rundirectory (%s) must either be a directory or a tar file (.tar)" % rundirectory)
+    return OpenRun(rundirectory).exists(file_name)
 
 def GetRun(rundirectory, *loadlist, strictMode=True, lazy_load_scintillation=True):
     data = []
-    for n in range(NEvent(rundirectory)):
-        data.append(GetEvent(rundirectory, n, *loadlist, strictMode=strictMode, lazy_load_scintillation=lazy_load_scintillation))
+    run = OpenRun(rundirectory)
+    for n in range(run.nevent()):
+        data.append(GetEvent(run, n, *loadlist, strictMode=strictMode, lazy_load_scintillation=lazy_load_scintillation))
 
     return data
 
-def GetEvent(rundirectory, ev, *loadlist, strictMode=True, lazy_load_scintillation=True):
+def IterRun(rundirectory, *loadlist, events=None, prefetch=2, workers=1, strictMode=True, lazy_load_scintillation=True, scint_columns=None, cam_grayscale=False, skip_errors=False, profile=None):
+    # Streaming alternative to GetRun. Yields (ev, event) pairs in order, while the next
+    # `prefetch` events are loaded on a pool of `workers` threads in the background.
+    # At most `prefetch` events are held in flight on top of the one being processed.
+    # Inputs:
+    #   events: Event numbers to load. Defaults to every event in the run
+    #   skip_errors: If True, events that fail to load are skipped with a warning instead of raising
+    #   profile: Optional StageProfile passed on to GetEvent
+    run = OpenRun(rundirectory)
+    if events is None:
+        events = range(run.nevent())
+
+    def load(ev):
+        return GetEvent(run, ev, *loadlist, strictMode=strictMode, lazy_load_scintillation=lazy_load_scintillation, scint_columns=scint_columns, cam_grayscale=cam_grayscale, profile=profile)
+
+    if prefetch <= 0:
+        for ev in events:
+            try:
+                event = load(ev)
+            except Exception as e:
+                if not skip_errors:
+                    raise
+                warnings.warn(f"Failed to load event {ev} with error: {e}. Skipping event.")
+                continue
+            yield ev, event
+        return
+
+    events = iter(events)
+    pool = ThreadPoolExecutor(max_workers=max(workers, 1))
+    pending = deque()
+    try:
+        for ev in itertools.islice(events, prefetch):
+            pending.append((ev, pool.submit(load, ev)))
+
+        while pending:
+            ev, future = pending.popleft()
+            # keep the queue full while the caller works on this event
+            for next_ev in itertools.islice(events, 1):
+                pending.append((next_ev, pool.submit(load, next_ev)))
+
+            try:
+                event = future.result()
+            except Exception as e:
+                if not skip_errors:
+                    raise
+                warnings.warn(f"Failed to load event {ev} with error: {e}. Skipping event.")
+                continue
+            del future
+            yield ev, event
+            del event
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+def GetEvent(rundirectory, ev, *loadlist, strictMode=True, lazy_load_scintillation=True, scint_columns=None, cam_grayscale=False, profile=None):
+    # scint_columns: If set, only these scintillation columns are made available (e.g. ["Waveforms"])
+    # cam_grayscale: If True, camera frames are 2D grayscale arrays instead of RGB. 8-bit grayscale PNGs are
+    #   decoded straight to uint8, color ones are averaged over RGB (in float32, like np.average(frame, axis=2))
+    # profile: Optional StageProfile to record the load time of each subsystem in
     event = dict()
 
-    if os.path.isdir(rundirectory):
-        is_tar = False
-    elif rundirectory.endswith(".tar"):
-        is_tar = True
-    else:
-        raise ValueError("Input rundirectory (%s) must either be a directory or a tar file (.tar)" % rundirectory)
+    run = OpenRun(rundirectory)
 
     # prepend the run directory if this isn't a tar file
-    event_dir = os.path.join(os.path.splitext(os.path.basename(rundirectory))[0], str(ev)) if is_tar else os.path.join(rundirectory, str(ev)) 
-    base_dir = rundirectory if not is_tar else os.path.splitext(os.path.basename(rundirectory))[0]
+    event_dir = run.event_dir(ev)
+    base_dir = run.base_dir()
     
     for key in full_loadlist:
         event[key] = dict(loaded=False)
@@ -96,9 +370,11 @@ def GetEvent(rundirectory, ev, *loadlist, strictMode=True, lazy_load_scintillati
     elif loadlist[0][0] == "~":
         loadlist = [l for l in full_loadlist if l not in [s.lstrip("~") for s in loadlist]]
 
+    tick = profile.ticker(ev) if profile is not None else (lambda stage: None)
+
     if "acoustics" in loadlist:
         acoustic_file = None
-        for fname in GetFiles(rundirectory, event_dir):
+        for fname in run.files(event_dir):
             if fname.startswith("acoustics"):
                 acoustic_file = os.path.join(event_dir, fname)
                 break
@@ -110,7 +386,7 @@ def GetEvent(rundirectory, ev, *loadlist, strictMode=True, lazy_load_scintillati
                 warnings.warn("No acoustics file present in the run directory. Data will not be available in the returned dictionary.")
         else:
             try:
-                acoustic_data = Streamer(acoustic_file).to_dict() if not is_tar else TarStreamer(rundirectory, acoustic_file).to_dict()
+                acoustic_data = run.streamer(acoustic_file).to_dict()
                 event["acoustics"]["loaded"] = True
                 for k, v in acoustic_data.items():
                     event["acoustics"][k] = v
@@ -119,11 +395,12 @@ def GetEvent(rundirectory, ev, *loadlist, strictMode=True, lazy_load_scintillati
                     raise e
                 else:
                     warnings.warn(f"Failed to load acoustics data with error: {e}")
-        
+        tick("load_acoustics")
+
     if "scintillation" in loadlist:
         scint_file = os.path.join(event_dir, "scintillation.sbc")
 
-        if not FileExists(rundirectory, scint_file):
+        if not run.exists(scint_file):
             if strictMode: 
                 raise FileNotFoundError("No scintillation file present in the run directory. To disable this error, either pass strictMode=False, or remove 'scintillation' from the loadlist")
             else:
@@ -131,14 +408,18 @@ def GetEvent(rundirectory, ev, *loadlist, strictMode=True, lazy_load_scintillati
         else:
             try:
                 if lazy_load_scintillation:
-                    scint = Streamer(scint_file, max_size=1000) if not is_tar else TarStreamer(rundirectory, scint_file, max_size=1000)
+                    scint = run.streamer(scint_file, max_size=1000)
                     for c in scint.columns:
-                        event["scintillation"][c] = lambda start=None, end=None, length=None: scint.to_dict(start=start, end=end, length=length)[c]
+                        if scint_columns is not None and c not in scint_columns:
+                            continue
+                        event["scintillation"][c] = lambda start=None, end=None, length=None, c=c: scint.to_dict(start=start, end=end, length=length)[c]
                     event["scintillation"]["length"] = scint.num_elems
                 else:
-                    scint = Streamer(scint_file) if not is_tar else TarStreamer(rundirectory, scint_file)
+                    scint = run.streamer(scint_file)
                     scint = scint.to_dict()
                     for k, v in scint.items():
+                        if scint_columns is not None and k not in scint_columns:
+                            continue
                         event["scintillation"][k] = v
                     event["scintillation"]["length"] = scint["Waveforms"].shape[0]
                 event["scintillation"]["loaded"] = True
@@ -147,65 +428,57 @@ def GetEvent(rundirectory, ev, *loadlist, strictMode=True, lazy_load_scintillati
                     raise e
                 else:
                     warnings.warn(f"Failed to load scintillation data with error: {e}")
+        tick("load_scintillation")
 
     if "cam" in loadlist:
         event["cam"]["loaded"] = True
         for cam_ind in range(1, 4):
             event["cam"]["c%i" % cam_ind] = {}
             cam_file = os.path.join(event_dir, "cam%i-info.csv" % cam_ind)
-            if not FileExists(rundirectory, cam_file):
+            if not run.exists(cam_file):
                 if strictMode: 
                     raise FileNotFoundError("Missing camera file (%s) in the run directory. To disable this error, either pass strictMode=False, or remove 'cam' from the loadlist" % str(cam_file))
                 else:
                     warnings.warn("Missing camera file in the run directory. Data will not be available in the returned dictionary.")
                 continue
 
-            if not is_tar:
-                cam_data = np.transpose(np.loadtxt(cam_file, delimiter=",", skiprows=1))
-            else:
-                with tarfile.open(rundirectory, "r") as tf:
-                    with tf.extractfile(cam_file) as f:
-                        cam_data = np.transpose(np.loadtxt(f, delimiter=",", skiprows=1))
+            cam_bytes = run.read(cam_file)
+            cam_data = np.transpose(np.loadtxt(io.BytesIO(cam_bytes), delimiter=",", skiprows=1))
 
             cam_data_headers = ["index"]
-
-            if not is_tar:
-                with open(cam_file) as f:
-                    first_line = f.readline()
-                    cam_data_headers += [s for s in first_line.rstrip("\n").split(",") if s]
-            else:
-                with tarfile.open(rundirectory, "r") as tf:
-                    with tf.extractfile(cam_file) as f:
-                        first_line = f.readline().decode("utf-8")
-                        cam_data_headers += [s for s in first_line.rstrip("\n").split(",") if s]
+            first_line = cam_bytes.split(b"\n", 1)[0].decode("utf-8")
+            cam_data_headers += [s for s in first_line.rstrip("\r").split(",") if s]
 
             for h, d in zip(cam_data_headers, cam_data):
                 event["cam"]["c%i" % cam_ind][h] = d
 
-        for fname in GetFiles(rundirectory, event_dir):
+        for fname in run.files(event_dir):
             if fname.startswith("cam") and fname.endswith(".png"):
                 img_file = os.path.join(event_dir, fname)
                 cam_ind = int(fname[3])
                 frame_ind = int(fname[8:10])
 
-                if not is_tar:
-                    event["cam"]["c%i" % cam_ind]["frame%i" % frame_ind] = np.array(Image.open(img_file).convert("RGB"))
+                img = Image.open(run.open(img_file))
+                if not cam_grayscale:
+                    frame = np.array(img.convert("RGB"))
+                elif img.mode == "L":
+                    frame = np.array(img)
                 else:
-                    with tarfile.open(rundirectory, "r") as tf:
-                        with tf.extractfile(img_file) as f:
-                            event["cam"]["c%i" % cam_ind]["frame%i" % frame_ind] = np.array(Image.open(io.BytesIO(f.read())).convert("RGB"))
+                    frame = np.float32(np.average(np.array(img.convert("RGB")), axis=2))
+                event["cam"]["c%i" % cam_ind]["frame%i" % frame_ind] = frame
+        tick("load_cam")
 
     if "event_info" in loadlist:
         event_file = os.path.join(event_dir, "event_info.sbc")
 
-        if not FileExists(rundirectory, event_file):
+        if not run.exists(event_file):
             if strictMode: 
                 raise FileNotFoundError("No event_info file present in the run directory. To disable this error, either pass strictMode=False, or remove 'event_info' from the loadlist")
             else:
                 warnings.warn("No event_info file present in the run directory. Data will not be available in the returned dictionary.")
         else:
             try:
-                event_data = Streamer(event_file).to_dict() if not is_tar else TarStreamer(rundirectory, event_file).to_dict()
+                event_data = run.streamer(event_file).to_dict()
                 event["event_info"]["loaded"] = True
                 for k, v in event_data.items():
                     event["event_info"][k] = v
@@ -214,17 +487,18 @@ def GetEvent(rundirectory, ev, *loadlist, strictMode=True, lazy_load_scintillati
                     raise e
                 else:
                     warnings.warn(f"Failed to load event_info data with error: {e}")
+        tick("load_event_info")
 
     if "slow_daq" in loadlist:
         slow_daq_file = os.path.join(event_dir, "slow_daq.sbc")
-        if not FileExists(rundirectory, slow_daq_file):
+        if not run.exists(slow_daq_file):
             if strictMode: 
                 raise FileNotFoundError("No slow_daq file present in the run directory. To disable this error, either pass strictMode=False, or remove 'slow_daq' from the loadlist")
             else:
                 warnings.warn("No slow_daq file present in the run directory. Data will not be available in the returned dictionary.")
         else:
             try:
-                slow_daq_data = Streamer(slow_daq_file).to_dict() if not is_tar else TarStreamer(rundirectory, slow_daq_file).to_dict()
+                slow_daq_data = run.streamer(slow_daq_file).to_dict()
                 event["slow_daq"]["loaded"] = True
                 for k, v in slow_daq_data.items():
                      event["slow_daq"][k] = v
@@ -233,17 +507,18 @@ def GetEvent(rundirectory, ev, *loadlist, strictMode=True, lazy_load_scintillati
                     raise e
                 else:
                     warnings.warn(f"Failed to load slow_daq data with error: {e}")
+        tick("load_slow_daq")
 
     if "plc" in loadlist:
         plc_file = os.path.join(event_dir, "plc.sbc")
-        if not FileExists(rundirectory, plc_file):
+        if not run.exists(plc_file):
             if strictMode: 
                 raise FileNotFoundError("No plc file present in the run directory. To disable this error, either pass strictMode=False, or remove 'plc' from the loadlist")
             else:
                 warnings.warn("No plc file present in the run directory. Data will not be available in the returned dictionary.")
         else:
             try:
-                plc_data = Streamer(plc_file).to_dict() if not is_tar else TarStreamer(rundirectory, plc_file).to_dict()
+                plc_data = run.streamer(plc_file).to_dict()
                 event["plc"]["loaded"] = True
                 for k, v in plc_data.items():
                     event["plc"][k] = v
@@ -252,17 +527,18 @@ def GetEvent(rundirectory, ev, *loadlist, strictMode=True, lazy_load_scintillati
                     raise e
                 else:
                     warnings.warn(f"Failed to load plc data with error: {e}")
+        tick("load_plc")
 
     if "run_info" in loadlist:
         run_info_file = os.path.join(base_dir, "run_info.sbc")
-        if not FileExists(rundirectory, run_info_file):
+        if not run.exists(run_info_file):
             if strictMode: 
                 raise FileNotFoundError("No run_info file present in the run directory. To disable this error, either pass strictMode=False, or remove 'run_info' from the loadlist")
             else:
                 warnings.warn("No run_info file present in the run directory. Data will not be available in the returned dictionary.")
         else:
             try:
-                run_info_data = Streamer(run_info_file).to_dict() if not is_tar else TarStreamer(rundirectory, run_info_file).to_dict()
+                run_info_data = run.streamer(run_info_file).to_dict()
                 event["run_info"]["loaded"] = True
                 for k, v in run_info_data.items():
                     event["run_info"][k] = v
@@ -271,21 +547,18 @@ def GetEvent(rundirectory, ev, *loadlist, strictMode=True, lazy_load_scintillati
                     raise e
                 else:
                     warnings.warn(f"Failed to load run_info data with error: {e}")
+        tick("load_run_info")
 
     if "run_control" in loadlist:
         run_ctrl_file = os.path.join(base_dir, "rc.json")
-        if not FileExists(rundirectory, run_ctrl_file):
+        if not run.exists(run_ctrl_file):
             if strictMode: 
                 raise FileNotFoundError("No run_control file present in the run directory. To disable this error, either pass strictMode=False, or remove 'run_control' from the loadlist")
             else:
                 warnings.warn("No run_control file present in the run directory. Data will not be available in the returned dictionary.")
         else:
             try:
-                doopen = open if not is_tar else tarfile.open
-                toopen = run_ctrl_file if not is_tar else rundirectory
-                with doopen(toopen, "r") as f:
-                    if is_tar:
-                        f = f.extractfile(run_ctrl_file)
+                with run.open(run_ctrl_file) as f:
                     run_ctrl_data = json.load(f)
                 event["run_control"]["loaded"] = True
                 for k, v in run_ctrl_data.items():
@@ -316,5 +589,6 @@ def GetEvent(rundirectory, ev, *loadlist, strictMode=True, lazy_load_scintillati
                     raise e
                 else:
                     warnings.warn(f"Failed to load run_control data with error: {e}")
+        tick("load_run_control")
 
     return event
@@ -0,0 +1,108 @@
+import sys
+import csv
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+columns = ["ev", "stage", "wall_s", "cpu_s", "read_bytes", "peak_rss_mb"]
+
+def _read_bytes():
+    # Bytes read by the calling thread so far (Linux only, otherwise 0)
+    try:
+        with open("/proc/thread-self/io", "r") as f:
+            for line in f:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+def _peak_rss_mb():
+    if resource is None:
+        return np.nan
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, kB on Linux
+    return maxrss / 1024**2 if sys.platform == "darwin" else maxrss / 1024
+
+class StageProfile:
+    # Collects wall time, CPU time, bytes read and peak RSS for each stage of each event.
+    # CPU time and bytes read are per thread, so stages running on loader threads are measured correctly.
+    def __init__(self):
+        self.rows = []
+        self._lock = threading.Lock()
+
+    def _snapshot(self):
+        return time.perf_counter(), time.thread_time(), _read_bytes()
+
+    def _record(self, ev, stage, start):
+        wall, cpu, nbytes = self._snapshot()
+        row = dict(ev=int(ev), stage=stage, wall_s=wall - start[0], cpu_s=cpu - start[1],
+                   read_bytes=nbytes - start[2], peak_rss_mb=_peak_rss_mb())
+        with self._lock:
+            self.rows.append(row)
+
+    @contextmanager
+    def stage(self, stage, ev=-1):
+        start = self._snapshot()
+        try:
+            yield
+        finally:
+            self._record(ev, stage, start)
+
+    def ticker(self, ev=-1):
+        # Returns a function tick(stage) that records the time since the previous tick
+        # (or since the ticker was made) as that stage. Useful for timing consecutive blocks of code.
+        last = [self._snapshot()]
+        def tick(stage):
+            self._record(ev, stage, last[0])
+            last[0] = self._snapshot()
+        return tick
+
+    def extend(self, rows):
+        with self._lock:
+            self.rows.extend(rows)
+
+    def write(self, path):
+        # Writes the profile to <path>.json and <path>.csv
+        with open(path + ".json", "w") as f:
+            json.dump(dict(rows=self.rows, summary=self.summarize()), f, indent=1)
+        with open(path + ".csv", "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(self.rows)
+
+    def summarize(self):
+        # Outputs: A dictionary by stage of count, totals and wall time percentiles
+        summary = {}
+        for stage in dict.fromkeys(r["stage"] for r in self.rows): # keep first-seen order
+            rows = [r for r in self.rows if r["stage"] == stage]
+            wall = np.array([r["wall_s"] for r in rows])
+            summary[stage] = dict(
+                n=len(rows),
+                wall_total_s=float(wall.sum()),
+                cpu_total_s=float(sum(r["cpu_s"] for r in rows)),
+                read_total_mb=sum(r["read_bytes"] for r in rows) / 1024**2,
+                wall_p50_s=float(np.percentile(wall, 50)),
+                wall_p90_s=float(np.percentile(wall, 90)),
+                wall_p99_s=float(np.percentile(wall, 99)),
+                wall_max_s=float(wall.max()),
+                peak_rss_mb=float(max(r["peak_rss_mb"] for r in rows)),
+            )
+        return summary
+
+    def print_summary(self):
+        summary = self.summarize()
+        header = ["stage", "n", "wall [s]", "cpu [s]", "read [MB]", "p50 [s]", "p90 [s]", "p99 [s]", "max [s]", "RSS [MB]"]
+        print("".join(h.rjust(12) if i else h.ljust(24) for i, h in enumerate(header)))
+        for stage, s in summary.items():
+            values = [s["n"], s["wall_total_s"], s["cpu_total_s"], s["read_total_mb"], s["wall_p50_s"],
+                      s["wall_p90_s"], s["wall_p99_s"], s["wall_max_s"], s["peak_rss_mb"]]
+            print(stage.ljust(24) + "".join(("%i" % v if isinstance(v, int) else "%.4g" % v).rjust(12) for v in values))
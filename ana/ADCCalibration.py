@@ -0,0 +1,64 @@
+import json
+import numpy as np
+
+NSIPM = 32 # number of SiPMs
+NCHAN_PER_GROUP = 8 # CAEN channels per group
+ADC_BITS = 12
+
+class ADCCalibration:
+    # Per-channel ADC -> mV calibration of the CAEN digitizer, built once from run_control["caen"].
+    # Channel i_sipm is channel i_sipm % 8 of group i_sipm // 8. For each channel:
+    #   offset: group offset + channel offset, in ADC counts
+    #   range: value of the group "range" setting in Vpp (e.g. "2.0_Vpp" -> 2.0)
+    # Traces in mV are (ADC - offset)*mV_per_count, with mV_per_count = range*1000/2**12.
+    # SiPMPulses historically works in (ADC - offset)*range instead, which is not mV. It asks for that
+    # scale explicitly (apply(..., scale=range)); everything else should use the default, mV.
+    def __init__(self, caen_ctrl, nsipm=NSIPM):
+        self.offset = np.empty(nsipm)
+        self.range = np.empty(nsipm)
+        for i_sipm in range(nsipm):
+            group_ctrl = caen_ctrl["group%i" % (i_sipm // NCHAN_PER_GROUP)]
+            self.offset[i_sipm] = group_ctrl["offset"] + group_ctrl["ch_offset"][i_sipm % NCHAN_PER_GROUP]
+            self.range[i_sipm] = float(group_ctrl["range"][:-4])
+
+    def _shape(self, vals, ndim, axis, nchan):
+        # Reshape a per-channel vector to broadcast along axis of an ndim array
+        shape = [1]*ndim
+        shape[axis] = nchan
+        return vals[:nchan].reshape(shape)
+
+    def apply(self, traces, axis=1, scale=None):
+        # Convert traces to mV in place, in one broadcast. axis is the SiPM axis of traces,
+        # which must be a floating point array. scale: per-channel factor applied after subtracting
+        # the offset, instead of mV_per_count. Returns traces
+        if scale is None:
+            scale = self.mV_per_count(len(self.range))
+        axis = axis % traces.ndim
+        nchan = traces.shape[axis]
+        traces -= self._shape(self.offset, traces.ndim, axis, nchan).astype(traces.dtype, copy=False)
+        traces *= self._shape(scale, traces.ndim, axis, nchan).astype(traces.dtype, copy=False)
+        return traces
+
+    def convert(self, data, channel):
+        # Returns a new array of data from one channel (an ADC trace, or a stack of them) in mV
+        return (np.asarray(data, dtype=float) - self.offset[channel])*self.mV_per_count(len(self.range))[channel]
+
+    def mV_per_count(self, nsipm=NSIPM):
+        # Size of one ADC count in mV for each channel
+        return self.range[:nsipm]*1000/2**ADC_BITS
+
+# Calibrations by the digitizer settings they were built from, so each run is parsed once per process
+_calibrations = {}
+
+def GetCalibration(run_control, nsipm=NSIPM):
+    # Inputs:
+    #   run_control: run_control dictionary of an event (ev["run_control"])
+    # Outputs: The cached ADCCalibration for these settings, or None if run_control has no CAEN groups
+    try:
+        groups = dict([("group%i" % g, run_control["caen"]["group%i" % g]) for g in range((nsipm - 1)//NCHAN_PER_GROUP + 1)])
+    except (KeyError, TypeError):
+        return None
+    key = (nsipm, json.dumps(groups, sort_keys=True, default=str))
+    if key not in _calibrations:
+        _calibrations[key] = ADCCalibration(groups, nsipm)
+    return _calibrations[key]
@@ -1,11 +1,12 @@
 from __future__ import division
 
-import copy
 import re
 
 import numpy as np
 import scipy.signal
 
+from ana import FilterBank
+
 def extend_window(w, r):
     # Inputs:
     #   w: An array of 2 elements. Normally, this will be a window like [t1, t2]
@@ -23,11 +24,12 @@ def freq_filter(freqs, lower=None, upper=None):
     # Outputs: An array of indices where the the frequency in freqs is between lower and upper
     if lower is None and upper is None:
         return freqs
+    freqs = np.asarray(freqs)
     if lower is None:
-        return np.where([x <= upper for x in freqs])
+        return np.where(freqs <= upper)
     if upper is None:
-        return np.where([x >= lower for x in freqs])
-    return np.where([lower <= x <= upper for x in freqs])
+        return np.where(freqs >= lower)
+    return np.where((lower <= freqs) & (freqs <= upper))
 
 
 def closest_index(arr, el):
@@ -48,11 +50,10 @@ def spectrum_sums(spectrum, fr, n, lowerf=None, upperf=None):
     #   upperf: The upper frequency to cut-off at
     # Outputs: A compressed 1d array where each element is the sum of a bin from spectrum, only counting
     #          frequencies between lowerf and upperf
-    out = []
     good_indices = freq_filter(fr, lowerf, upperf)
-    for subn in range(n):
-        out.append(np.trapezoid(spectrum[good_indices[0], subn], dx=np.mean(np.diff(fr))))
-    return out
+    # integrate all n time slices at once. Each slice is made contiguous, so the sums are the same as slice by slice
+    band = np.ascontiguousarray(spectrum[good_indices[0], :n].T)
+    return np.trapezoid(band, dx=np.mean(np.diff(fr)), axis=-1)
 
 
 def rescale_window(w1, w2):
@@ -69,6 +70,9 @@ def rescale_window(w1, w2):
     return a*w2+b
 
 
+# Correlation templates by (tau, dt, n, fit_type, shift). They are read-only, since they are shared
+_corr_templates = {}
+
 def corr_signal(tau, dt, t0, n, fit_type=0, shift=10):
     # Inputs:
     #   tau: Time constant on exponential decay
@@ -87,29 +91,25 @@ def corr_signal(tau, dt, t0, n, fit_type=0, shift=10):
     # After careful analysis, we've determined that there reaches a point in the filtered piezo signal that
     # exhibits a sharp increase followed by an exponential decay. This function returns a brief exponential
     # decay function for use with convolution/correlation.
+    # The template only depends on t-t0, so it is built once per (tau, dt, n, fit_type, shift) and cached.
     shift = int(np.ceil(shift))
-    t = np.linspace(t0, t0+dt*n, n)
-    y = np.exp(-(t-t0)/tau)
-    ycopy = copy.deepcopy(y)
-    if fit_type == 0:
-        pass
-    elif fit_type == 1:
-        for subn in range(len(y) - shift):
-            y[subn+shift] = ycopy[subn]
-        y[0:shift] = 1
-    elif fit_type == 2:
-        for subn in range(len(y) - shift):
-            y[subn + shift] = ycopy[subn]
-        y[0:shift] = (t[0:shift] - t0)/(shift*dt)
-    elif fit_type == 3:
-        for subn in range(len(y) - shift):
-            y[subn + shift] = ycopy[subn]
-            y[0:shift] = np.log((t[0:shift] + 1 - t0)) / np.log(shift*dt + 1)
-    elif fit_type == 4:
-        for subn in range(len(y) - shift):
-            y[subn+shift] = ycopy[subn]
-            y[0:shift] = 0
-    return t, y
+    t_rel = np.linspace(0, dt*n, n)
+    key = (tau, dt, n, fit_type, shift)
+    if key not in _corr_templates:
+        y = np.exp(-t_rel/tau)
+        if fit_type in (1, 2, 3, 4):
+            # the exponential starts shift samples late, after a lead-in that depends on fit_type
+            y[shift:] = y[:max(len(y) - shift, 0)].copy()
+            lead = t_rel[0:shift]
+            if fit_type == 1:
+                y[0:shift] = 1
+            elif fit_type == 2:
+                y[0:shift] = lead/(shift*dt)
+            elif len(y) > shift: # types 3 and 4 only set the lead-in when the exponential fits
+                y[0:shift] = np.log(lead + 1) / np.log(shift*dt + 1) if fit_type == 3 else 0
+        y.setflags(write=False)
+        _corr_templates[key] = y
+    return t0 + t_rel, _corr_templates[key]
 
 def find_t0_from_corr(corrt, corry):
     # Inputs:
@@ -121,19 +121,25 @@ def find_t0_from_corr(corrt, corry):
     return corrt[np.argmax(corry)]
 
 def spectrogram(piezo_waveform, timebase):
+    # piezo_waveform can also be a stack of waveforms, along the last axis
     dt = np.mean(np.diff(timebase))
     return scipy.signal.spectrogram(piezo_waveform, fs=1./dt, nfft=512, noverlap=450,
                                               mode="psd", window="hann", nperseg=512)
 
-def find_peakt0(raw_piezo, times, t0_win, f_low, f_high, n_sample_baseline):
-    filtered_piezo = BandPass2(raw_piezo - np.mean(raw_piezo[:n_sample_baseline]), f_low, f_high)
+def find_peakt0(raw_piezo, times, t0_win, f_low, f_high, n_sample_baseline, fs=None):
+    # raw_piezo can also be a stack of waveforms, along the last axis. Returns one time per waveform
+    # fs: Sample rate in Hz, by default from the spacing of times
     dt = times[1] - times[0]
+    if fs is None:
+        fs = 1./dt
+    filtered_piezo = BandPass2(raw_piezo - np.mean(raw_piezo[..., :n_sample_baseline], axis=-1, keepdims=True),
+                               f_low, f_high, fs=fs)
     t0_win_ix = np.intp(np.round((t0_win - times[0]) / dt))
-    peak_index = np.argmax(np.abs(filtered_piezo[t0_win_ix[0]:t0_win_ix[1]])) + t0_win_ix[0]
+    peak_index = np.argmax(np.abs(filtered_piezo[..., t0_win_ix[0]:t0_win_ix[1]]), axis=-1) + t0_win_ix[0]
     return times[peak_index]
 
 def calculate_t0(piezo_waveform, piezo_timebase, tau, n_sample_baseline=1000,
-                 lower=20000, upper=40000, piezo_fit_type=0):
+                 lower=20000, upper=40000, piezo_fit_type=0, spec=None):
     # Inputs:
     #   piezo_waveform: Piezoelectric waveform
     #   piezo_timebase: The times of each element in the piezo_waveform
@@ -144,11 +150,12 @@ def calculate_t0(piezo_waveform, piezo_timebase, tau, n_sample_baseline=1000,
     #   upper: The upper frequency threshold for cutting off the spectrogram
     #   piezo_fit_type: The type of fit to use when trying to match the filtered piezo signal. Defaults to 0.
     #   view_plots: Boolean. If true, will display some plots for analysis.
+    #   spec: (fr, bn, sp) spectrogram of piezo_waveform, if already computed
     # Outputs: A dictionary of results for the Acoustic Analysis.
     try:
         timebase = piezo_timebase
         dt = np.mean(np.diff(timebase))
-        fr, bn, sp = spectrogram(piezo_waveform, timebase)
+        fr, bn, sp = spectrogram(piezo_waveform, timebase) if spec is None else spec
         n = len(bn)
         sp_sums = spectrum_sums(sp, fr, n, lower, upper)
         sp_sums = scipy.signal.medfilt(sp_sums)
@@ -194,46 +201,60 @@ def calculate_t0(piezo_waveform, piezo_timebase, tau, n_sample_baseline=1000,
         raise
         return np.nan
 
-def BandPass2(yd, f_low, f_high):
-    fband = np.array([f_low, f_high])
-    b, a = scipy.signal.butter(2, fband / (2.5e6 / 2.0), btype='bandpass', output='ba')
-    yd_f = scipy.signal.filtfilt(b, a, yd)
-    return yd_f
+def BandPass2(yd, f_low, f_high, fs=2.5e6, axis=-1, order=2):
+    # Zero-phase Butterworth band-pass of yd along axis, so a stack of waveforms is filtered in one call.
+    # fs is the sample rate in Hz. The filter comes from the shared filter bank, designed once per (order, band, fs)
+    return FilterBank.Filter(yd, order, [f_low, f_high], fs, axis=axis)
 
 def CalcPiezoE(yd, td, t_wins, f_bins, t0):
-    piezoE = np.zeros((t_wins.shape[0],
+    # Inputs:
+    #   yd: Piezo waveform, or a stack of waveforms along the last axis
+    #   td: Times of the samples
+    #   t_wins: Time windows relative to t0, shape (n windows, 2)
+    #   f_bins: Edges of the frequency bins
+    #   t0: Time of the bubble, one per waveform
+    # Outputs: Energy in each window and frequency bin, shape yd.shape[:-1] + (n windows, n bins).
+    #   NaN for waveforms without a t0 and for windows shorter than 2 samples
+    # Windows of the same length are transformed together, with one rFFT over all windows and waveforms,
+    # and the bins are summed from the cumulative sum of the energy spectrum
+    yd = np.asarray(yd)
+    lead_shape = yd.shape[:-1]
+    yd = yd.reshape((-1, yd.shape[-1]))
+    t0 = np.broadcast_to(np.asarray(t0, dtype=np.float64), lead_shape).ravel()
+
+    piezoE = np.zeros((yd.shape[0], t_wins.shape[0],
                        f_bins.shape[0] - 1),
                       dtype=np.float64) + np.nan
 
-    if np.isnan(t0):
-        return piezoE
-
     dt = td[1] - td[0]
-    t_wins = t_wins + t0
+    t_wins = t_wins[None, :, :] + np.where(np.isnan(t0), 0, t0)[:, None, None] # no windows without a t0
     t_wins_ix = np.intp(np.round((t_wins - td[0]) / dt))
     t_wins_ix[t_wins_ix < 0] = 0
     t_wins_ix[t_wins_ix > td.shape[0]] = td.shape[0]
+    win_len = t_wins_ix[..., 1] - t_wins_ix[..., 0]
+    usable = ~np.isnan(t0)[:, None] & (win_len >= 2)
 
+    for n in np.unique(win_len[usable]):
+        i_wvf, i_win = np.nonzero(usable & (win_len == n))
+        this_yd = yd[i_wvf[:, None], t_wins_ix[i_wvf, i_win, 0][:, None] + np.arange(n)]
+        fft_amp = np.fft.rfft(this_yd, axis=-1)
+        fft_pow = (np.abs(fft_amp) ** 2) * dt / n
 
-    for i_win in range(t_wins.shape[0]):
-        this_yd = yd[t_wins_ix[i_win][0]:t_wins_ix[i_win][1]]
-        if len(this_yd) < 2:
-            continue
-        fft_amp = np.fft.rfft(this_yd)
-        fft_pow = (np.abs(fft_amp) ** 2) * dt / len(this_yd)
-
-        df = 1 / (dt * len(this_yd))
-        fd = df * (np.arange(len(fft_amp), dtype=np.float64) + 1)
+        df = 1 / (dt * n)
+        fd = df * (np.arange(fft_amp.shape[-1], dtype=np.float64) + 1)
         f_bins_ix = np.intp(np.round((f_bins / df) - 1))
         f_bins_ix[f_bins_ix < 0] = 0
-        f_bins_ix[f_bins_ix > len(fft_amp)] = len(fft_amp)
+        f_bins_ix[f_bins_ix > fft_amp.shape[-1]] = fft_amp.shape[-1]
 
         fft_en = fft_pow * (fd ** 2)
-        for i_f in range(len(f_bins) - 1):
-            piezoE[i_win, i_f] = df *\
-                np.sum(fft_en[f_bins_ix[i_f]:f_bins_ix[i_f + 1]])
+        cum_en = np.zeros((fft_en.shape[0], fft_en.shape[1] + 1))
+        np.cumsum(fft_en, axis=-1, out=cum_en[:, 1:])
+        # empty bins (upper edge below the lower one) sum to 0
+        lower = f_bins_ix[:-1]
+        upper = np.maximum(f_bins_ix[1:], lower)
+        piezoE[i_wvf, i_win] = df * (cum_en[:, upper] - cum_en[:, lower])
 
-    return piezoE
+    return piezoE.reshape(lead_shape + piezoE.shape[1:])
 
 
 
@@ -270,7 +291,11 @@ def AcousticAnalysis(ev, tau=0, piezo_fit_type=0,
         rnge = ev["acoustics"]["Range"]
         dcoffset = ev["acoustics"]["DCOffset"]
 
-        dt = 1/(float(ev["run_control"]["acous"]["sample_rate"][:-5])*1e6) # convert MHz -> Hz
+        if "sample_rate" in ev["acoustics"]: # parsed by GetEvent from run_control
+            fs = float(ev["acoustics"]["sample_rate"])
+        else:
+            fs = float(ev["run_control"]["acous"]["sample_rate"][:-5])*1e6 # convert MHz -> Hz
+        dt = 1/fs
         times = np.arange(wvfs.shape[-1])*dt
   
     except:
@@ -283,22 +308,27 @@ def AcousticAnalysis(ev, tau=0, piezo_fit_type=0,
 
     wvfs = (wvfs.T/rnge.T - dcoffset.T).T # convert to mV, subtract offset
 
+    # The band-pass filter and the spectrogram run on all channels at once
+    raw_piezos = wvfs[0]
+    out["peak_t0"][:] = find_peakt0(raw_piezos, times, t0_win, f_low, f_high, n_sample_baseline, fs=fs)
+    fr, bn, sps = spectrogram(raw_piezos, times)
+
     for i_piezo in range(wvfs.shape[1]):
         try:
-            raw_piezo = wvfs[0, i_piezo, :]
+            raw_piezo = raw_piezos[i_piezo]
 
-            out["peak_t0"][i_piezo] = find_peakt0(raw_piezo, times, t0_win, f_low, f_high, n_sample_baseline)
             t0 = calculate_t0(raw_piezo, times, n_sample_baseline=n_sample_baseline,
                               tau=tau, lower=corr_lowerf, upper=corr_upperf,
-                              piezo_fit_type=piezo_fit_type)
+                              piezo_fit_type=piezo_fit_type, spec=(fr, bn, sps[i_piezo]))
             out["bubble_t0"][i_piezo] = t0
-            t0_index = closest_index(times, t0)
-
-            out["piezoE"][i_piezo,:,:] = CalcPiezoE(raw_piezo, times, t_wins, f_bins, times[t0_index])
 
         except Exception as e:
             raise
 
+    # piezo energy of all channels together, from the sample closest to each t0
+    t0_index = [closest_index(times, t0) for t0 in out["bubble_t0"]]
+    out["piezoE"][:] = CalcPiezoE(raw_piezos, times, t_wins, f_bins, times[t0_index])
+
     return out
 
 
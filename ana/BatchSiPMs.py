@@ -1,10 +1,84 @@
 # from tqdm.auto import tqdm as tq
-from tqdm import tqdm 
+from tqdm import tqdm
 from multiprocess import Pool
-from GetEvent import GetScint
+from multiprocessing import shared_memory
+from GetEvent import GetScint, scint_helper_keys
+from ana import ADCCalibration
+import functools
 import numpy as np
 
-def BatchSiPMs(ev, ana_f, nwvf_batch=1000, maxwvf=-1, progress=False, njob=1, **f_kwargs):
+# Per-process state of the shared memory workers, set up once by _init_shared_worker
+_shared = {}
+
+# Subsystems of the event the batch analyses read besides the scintillation data, which are all that is sent
+# to the shared memory workers
+WORKER_KEYS = ["run_control", "event_info"]
+
+def _attach(name):
+    # Python >= 3.13 lets us opt out of the resource tracker, which would otherwise
+    # try to clean up blocks owned by the parent process
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+def _share_scintillation(ev, nwvf, nwvf_batch):
+    # Decode the scintillation columns of ev once, batch by batch, into shared memory blocks
+    # Outputs: (list of SharedMemory blocks, dict of column -> (block name, shape, dtype))
+    blocks = []
+    specs = {}
+    arrays = {}
+    try:
+        for start in range(0, nwvf, nwvf_batch):
+            end = min(start + nwvf_batch, nwvf)
+            scint = GetScint(ev, start=start, end=end)["scintillation"]
+            for key, chunk in scint.items():
+                if key in scint_helper_keys:
+                    continue
+                chunk = np.asarray(chunk)
+                if key not in arrays:
+                    shape = (nwvf,) + chunk.shape[1:]
+                    shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape))*chunk.dtype.itemsize, 1))
+                    blocks.append(shm)
+                    arrays[key] = np.ndarray(shape, dtype=chunk.dtype, buffer=shm.buf)
+                    specs[key] = (shm.name, shape, chunk.dtype.str)
+                arrays[key][start:end] = chunk
+    except:
+        del arrays
+        _release(blocks)
+        raise
+    return blocks, specs
+
+def _release(blocks):
+    for shm in blocks:
+        shm.close()
+        shm.unlink()
+
+def _init_shared_worker(ev, specs, ana_f, f_kwargs):
+    _shared["ev"] = ev
+    _shared["ana_f"] = ana_f
+    _shared["f_kwargs"] = f_kwargs
+    _shared["blocks"] = []
+    _shared["arrays"] = {}
+    for key, (name, shape, dtype) in specs.items():
+        shm = _attach(name)
+        _shared["blocks"].append(shm)
+        _shared["arrays"][key] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+def _apply_shared(bounds):
+    start, end = bounds
+    ev = dict(_shared["ev"])
+    ev["scintillation"] = dict(ev["scintillation"])
+    for key, arr in _shared["arrays"].items():
+        ev["scintillation"][key] = arr[start:end]
+    return start, _shared["ana_f"](ev, **_shared["f_kwargs"])
+
+def BatchSiPMs(ev, ana_f, nwvf_batch=1000, maxwvf=-1, progress=False, njob=1, share_memory=True, **f_kwargs):
+    # ana_f: Analysis of one batch. It declares the outputs with one row per trigger (trigger along axis 0)
+    #   in an attribute, ana_f.per_trigger_outputs. Other outputs are concatenated along axis 0
+    # share_memory: With njob > 1, decode the waveforms once in this process into shared memory.
+    #   Workers then get the event without its scintillation data once, at startup, and each task is
+    #   only a (start, end) range into the shared arrays. Otherwise each task pickles the whole event.
     # load defaults
     output = ana_f(None)
 
@@ -18,19 +92,30 @@ def BatchSiPMs(ev, ana_f, nwvf_batch=1000, maxwvf=-1, progress=False, njob=1, **
 
     print("BATCHING %i pulses" % nwvf)
 
+    # Parse the digitizer calibration once up front, so every batch (and forked worker) reuses it
+    if "run_control" in ev:
+        ADCCalibration.GetCalibration(ev["run_control"])
+
     if nwvf == 0:
         return output
 
-    batched_outputs = []
-
     itr = list(range(0, nwvf, nwvf_batch))
     nitr = len(itr)
 
     def applyf(start):
         end = min(start + nwvf_batch, nwvf)
-        return ana_f(GetScint(ev, start=start, end=end), **f_kwargs)
+        return start, ana_f(GetScint(ev, start=start, end=end), **f_kwargs)
 
-    if njob > 1:
+    blocks = []
+    if njob > 1 and share_memory:
+        blocks, specs = _share_scintillation(ev, nwvf, nwvf_batch)
+        # only what the analyses read goes to the workers, once, at startup: the WORKER_KEYS subsystems and the
+        # scintillation helper values. Lazily loaded columns (e.g. EventCounter) stay behind
+        light_ev = dict([(k, ev[k]) for k in WORKER_KEYS if k in ev])
+        light_ev["scintillation"] = dict([(k, v) for (k, v) in ev["scintillation"].items() if k in scint_helper_keys and not callable(v)])
+        pool = Pool(processes=njob, initializer=_init_shared_worker, initargs=(light_ev, specs, ana_f, f_kwargs))
+        itr = pool.imap_unordered(_apply_shared, [(start, min(start + nwvf_batch, nwvf)) for start in itr])
+    elif njob > 1:
         pool = Pool(processes=njob)
         itr = pool.imap_unordered(applyf, itr)
     else:
@@ -39,14 +124,67 @@ def BatchSiPMs(ev, ana_f, nwvf_batch=1000, maxwvf=-1, progress=False, njob=1, **
     if progress:
         itr = tqdm(itr, total=nitr)
 
-    for pulses in itr:
-        batched_outputs.append(pulses)
+    # Outputs with one row per trigger are written straight into arrays covering all triggers,
+    # allocated when the first batch arrives, so batches can come back in any order.
+    # Any other outputs are kept per batch and concatenated in trigger order at the end.
+    per_trigger = set(getattr(ana_f, "per_trigger_outputs", ()))
+    full_outputs = {}
+    batch_outputs = {}
+
+    try:
+        for start, pulses in itr:
+            end = min(start + nwvf_batch, nwvf)
+            for key in output.keys():
+                val = np.asarray(pulses[key])
+                if key not in full_outputs and key not in batch_outputs:
+                    if key in per_trigger:
+                        full_outputs[key] = np.empty((nwvf,) + val.shape[1:], dtype=val.dtype)
+                    else:
+                        batch_outputs[key] = {}
 
-    if njob > 1:
-        pool.close()
+                if key in full_outputs:
+                    if val.ndim == 0 or val.shape[0] != end - start:
+                        raise ValueError("Output %s of %s has shape %s for a batch of %i triggers" % (key, getattr(ana_f, "__name__", ana_f), val.shape, end - start))
+                    full_outputs[key][start:end] = val
+                else:
+                    batch_outputs[key][start] = val
+            del pulses
+    finally:
+        if njob > 1:
+            pool.close()
+            pool.join()
+        _release(blocks)
 
-    # concatenate the outputs
     for key in output.keys():
-        output[key] = np.concatenate([b[key] for b in batched_outputs], axis=0) 
-        
+        if key in full_outputs:
+            output[key] = full_outputs[key]
+        elif key in batch_outputs:
+            output[key] = np.concatenate([batch_outputs[key][start] for start in sorted(batch_outputs[key])], axis=0)
+
+    return output
+
+def _fused(ev, ana_fs):
+    # Run several analyses on the same batch. Outputs are keyed by (analysis name, output name)
+    out = {}
+    for name, (f, f_kwargs) in ana_fs.items():
+        result = f(None) if ev is None else f(ev, **f_kwargs)
+        for key, val in result.items():
+            out[(name, key)] = val
+    return out
+
+def BatchSiPMsFused(ev, ana_fs, nwvf_batch=1000, maxwvf=-1, progress=False, njob=1, share_memory=True):
+    # Batch several per-trigger analyses together, so the waveforms are read once for all of them.
+    # Inputs:
+    #   ana_fs: Dictionary of analysis name -> (analysis function, keyword arguments). The functions
+    #           must follow the BatchSiPMs conventions and must not modify their input, since they all
+    #           see the same batch
+    # Outputs: Dictionary of analysis name -> output, the same as running BatchSiPMs on each one
+    fused_f = functools.partial(_fused, ana_fs=ana_fs)
+    fused_f.per_trigger_outputs = [(name, key) for name, (f, _) in ana_fs.items() for key in getattr(f, "per_trigger_outputs", ())]
+    fused = BatchSiPMs(ev, fused_f, nwvf_batch=nwvf_batch, maxwvf=maxwvf,
+                       progress=progress, njob=njob, share_memory=share_memory)
+
+    output = dict([(name, {}) for name in ana_fs.keys()])
+    for (name, key), val in fused.items():
+        output[name][key] = val
     return output
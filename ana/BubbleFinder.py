@@ -4,6 +4,7 @@ import matplotlib.pyplot as plt
 from skimage.draw import circle_perimeter, disk
 from skimage.measure import label, regionprops
 import diplib as dip
+from concurrent.futures import ThreadPoolExecutor
 
 """
 Args:
@@ -29,9 +30,95 @@ bub_dict_keys = ["bub_num", "cam", "pos", "radius", "significance", "frame"]
 def _new_bub_dict():
     return dict([(key, []) for key in bub_dict_keys])
 
+# Circle Hough transform
+# The accumulator layer of radius rad is the sum of np.roll(image, offset) over the offsets of the
+# circle perimeter, i.e. the circular convolution of image with a ring kernel. It is computed with FFTs,
+# for all radii at once, and only over a region of interest (ROI) of the image: the rows and columns
+# that can vote into the ROI are cut out of image (wrapping around the edges like np.roll), and
+# convolved with ring kernels of that size
+def _perimeter_offsets(rad, Tshape):
+    circx, circy = circle_perimeter(600, 400, int(rad), shape=Tshape)
+    return circx-600, circy-400
+
+def _snap(accum, image):
+    # Votes are sums of image values. If those are floats on a common grid (true for diffs of float32
+    # images), round the FFT result back onto it, so the votes and their ties match the direct sums exactly
+    values = np.abs(image[image != 0])
+    if values.size == 0:
+        return np.zeros_like(accum)
+    step = np.spacing(np.float32(values.min()))
+    if np.all(np.mod(values, step) == 0):
+        accum = np.round(accum/step)*step
+    return accum
+
+def HoughLayers(image, rads, Tshape, roi=None):
+    # Inputs:
+    #   image: 2D image to vote with
+    #   rads: circle radii in pixels
+    #   Tshape: transposed image shape, which circle_perimeter clips the ring offsets to
+    #   roi: (y0, y1, x0, x1) bounds of the accumulator to compute. Defaults to the full image
+    # Outputs: Hough accumulator over the ROI, with shape (y1-y0, x1-x0, len(rads))
+    imShape = image.shape
+    y0, y1, x0, x1 = (0, imShape[0], 0, imShape[1]) if roi is None else roi
+    offsets = [_perimeter_offsets(rad, Tshape) for rad in rads]
+    # (offsets can be empty for radii clipped away by Tshape)
+    dx_min = min(np.min(dx, initial=0) for dx, _ in offsets)
+    dx_max = max(np.max(dx, initial=0) for dx, _ in offsets)
+    dy_min = min(np.min(dy, initial=0) for _, dy in offsets)
+    dy_max = max(np.max(dy, initial=0) for _, dy in offsets)
+
+    # pixel (y, x) of the ROI gets votes from image[y-dx, x-dy], so pad the ROI by the offsets
+    rows = np.arange(y0 - dx_max, y1 - dx_min) % imShape[0]
+    cols = np.arange(x0 - dy_max, x1 - dy_min) % imShape[1]
+    patch = image[np.ix_(rows, cols)]
+
+    kernels = np.zeros((len(rads),) + patch.shape)
+    for k, (dx, dy) in enumerate(offsets):
+        np.add.at(kernels[k], (dx - dx_min, dy - dy_min), 1) # perimeter points may repeat
+    # transform in float64: float32 input would run in complex64, whose error is larger than the _snap grid
+    layers = np.fft.irfft2(np.fft.rfft2(patch.astype(np.float64))*np.fft.rfft2(kernels), s=patch.shape)
+    # the kernel origin is at (dx_min, dy_min), so ROI pixel (y, x) is at (y - y0 + dx_max - dx_min, ...)
+    layers = layers[:, dx_max - dx_min:dx_max - dx_min + y1 - y0, dy_max - dy_min:dy_max - dy_min + x1 - x0]
+    return _snap(np.moveaxis(layers, 0, -1), patch)
+
+def _roi(centroids, rad, imShape):
+    # Bounds (y0, y1, x0, x1) of all pixels within rad of the centroids
+    ys = []
+    xs = []
+    for cy, cx in centroids:
+        y, x = disk((cy, cx), rad, shape=imShape)
+        ys.append(y)
+        xs.append(x)
+    ys = np.concatenate(ys)
+    xs = np.concatenate(xs)
+    return ys.min(), ys.max() + 1, xs.min(), xs.max() + 1
+
+def _peak(regIm, roi):
+    # Position (y, x, radius index) in the full image of the maximum of an accumulator over the ROI,
+    # that is zero outside some region. Matches np.argmax over the full image, which falls on
+    # the first pixel of the image when the region has no votes
+    if np.max(regIm) <= 0:
+        return np.unravel_index(0, regIm.shape)
+    pcy, pcx, rad_ind = np.unravel_index(np.argmax(regIm), regIm.shape)
+    return pcy + roi[0], pcx + roi[2], rad_ind
+
+class GrayFrames:
+    # Grayscale float32 frames of one camera, each converted once on first use and then reused.
+    # Color frames are averaged over RGB, grayscale frames (see GetEvent cam_grayscale) are used as they are
+    def __init__(self, cam_data):
+        self.cam_data = cam_data
+        self.frames = {}
+
+    def __getitem__(self, frame_ind):
+        if frame_ind not in self.frames:
+            frame = self.cam_data[f'frame{frame_ind}']
+            self.frames[frame_ind] = np.float32(np.average(frame, axis=2)) if np.ndim(frame) == 3 else np.float32(frame)
+        return self.frames[frame_ind]
+
 def FindBubbles(ev, cam, num_pix_in_neighborhood, noise_thresh, bub_dict=None):
+    gray = GrayFrames(ev['cam'][f'c{cam}'])
     #get mask for bubble region based on camera
-    refIm = np.float32(np.average(ev['cam'][f'c{cam}']['frame0'],axis=2))
+    refIm = gray[0]
     imShape = refIm.shape
     Tshape = imShape[::-1]
     
@@ -82,8 +169,8 @@ def FindBubbles(ev, cam, num_pix_in_neighborhood, noise_thresh, bub_dict=None):
     
         im_num = i
     
-        thisIm = np.float32(np.average(ev['cam'][f'c{cam}'][f'frame{im_num-1}'],axis=2))
-        nextIm = np.float32(np.average(ev['cam'][f'c{cam}'][f'frame{im_num}'],axis=2)) #may have to be changed later to account for missing frames
+        thisIm = gray[im_num-1]
+        nextIm = gray[im_num] #may have to be changed later to account for missing frames
     
         #get diff and mask out noise
         preMask_diff = abs(thisIm-nextIm)
@@ -132,28 +219,15 @@ def FindBubbles(ev, cam, num_pix_in_neighborhood, noise_thresh, bub_dict=None):
                 max_rad = min_est_rad + 3
             rad_cands = np.arange(min_rad, max_rad,1)
             
-            #perform CHT
-            for rad in rad_cands:
-                circx, circy = circle_perimeter(600, 400, int(rad), shape=Tshape)
-                dx = circx-600
-                dy = circy-400
-                offsets = [(dx[i],dy[i]) for i in range(len(dx))]
-    
-                this_layer = np.zeros((imShape[0], imShape[1]))
-                for offset in offsets:
-                    this_layer += np.roll(diff, offset,(0,1))
-    
-                if rad==rad_cands[0]:
-                    accum = this_layer
-                else:
-                    accum = np.dstack((accum, this_layer))
-    
+            #perform CHT, only where the accumulator is used: around the candidate regions
+            roi = _roi([region.centroid for region in largest_regions], 20, imShape)
+            accum = HoughLayers(diff, rad_cands, Tshape, roi)
             accum_shape = accum.shape
     
             #get vote threshold -- 80% of highest peak number of votes
             largest_cy, largest_cx = largest_region.centroid
             largest_y, largest_x = disk((largest_cy, largest_cx), 20, shape=imShape)
-            max_votes = np.max(accum[largest_y, largest_x])
+            max_votes = np.max(accum[largest_y - roi[0], largest_x - roi[2]])
             vote_thresh = max_votes*.8
             
             #now we enter the candidate loop and decide based on votes whether to keep or discard each candidate
@@ -172,36 +246,25 @@ def FindBubbles(ev, cam, num_pix_in_neighborhood, noise_thresh, bub_dict=None):
                     while t0_found==False:
                         
                         #get diff
-                        pastIm = np.float32(np.average(ev['cam'][f'c{cam}'][f'frame{im_num-j}'], axis=2))
+                        pastIm = gray[im_num-j]
                         pastDiff = abs(pastIm - refIm)
                         pastDiff[pastDiff<noise_thresh] = 0
                         pastDiff-=dip.GetSinglePixels(pastDiff > 0)
     
                         #perform CHT
+                        #the past accumulator has always been the current accum with the last past layer
+                        #stacked on top, so only that layer is computed
                         rad_cands = [2,3,4]
-                        for rad in rad_cands:
-                            circx, circy = circle_perimeter(600, 400, int(rad), shape=Tshape)
-                            dx = circx-600
-                            dy = circy-400
-                            offsets = [(dx[i],dy[i]) for i in range(len(dx))]
-    
-                            this_layer = np.zeros((imShape[0], imShape[1]))
-                            for offset in offsets:
-                                this_layer += np.roll(pastDiff, offset,(0,1))
-    
-                            if rad==rad_cands[0]:
-                                past_accum = this_layer
-                            else:
-                                past_accum = np.dstack((accum, this_layer))
+                        past_accum = np.dstack((accum, HoughLayers(pastDiff, rad_cands[-1:], Tshape, roi)))
     
                         past_accum_shape = past_accum.shape
     
                         #paste relevant region of accumulator onto blank image
                         pastregIm = np.zeros(past_accum_shape)
-                        pastregIm[largest_y, largest_x] = past_accum[largest_y, largest_x]
+                        pastregIm[largest_y - roi[0], largest_x - roi[2]] = past_accum[largest_y - roi[0], largest_x - roi[2]]
     
                         #find peak candidate 
-                        pcy, pcx, rad_ind = np.unravel_index(np.argmax(pastregIm), past_accum_shape)
+                        pcy, pcx, rad_ind = _peak(pastregIm, roi)
                         prad = rad_ind + rad_cands[0]
     
                         #check if bubble candidate meets intensity thresh for the noise in the image
@@ -230,13 +293,13 @@ def FindBubbles(ev, cam, num_pix_in_neighborhood, noise_thresh, bub_dict=None):
                 rcy, rcx = region.centroid
                 ry, rx = disk((rcy,rcx), 20, shape=imShape)
                 regIm = np.zeros(accum_shape)
-                regIm[ry,rx] = accum[ry, rx]
+                regIm[ry - roi[0], rx - roi[2]] = accum[ry - roi[0], rx - roi[2]]
                 votes = np.max(regIm)
                 
                 if votes>=vote_thresh:
                     
                     #get peak candidate in this constrained region of connected pixels
-                    pcy, pcx, rad_ind = np.unravel_index(np.argmax(regIm), accum_shape)
+                    pcy, pcx, rad_ind = _peak(regIm, roi)
                     prad = rad_ind + min_rad
     
                     #add bubble to dictionary
@@ -251,15 +314,30 @@ def FindBubbles(ev, cam, num_pix_in_neighborhood, noise_thresh, bub_dict=None):
                 
                     #zero out accumulator array for all radii around this point
                     circy, circx = disk((pcy, pcx), prad+num_pix_in_neighborhood, shape=imShape)
-                    accum[circy,circx] = 0
+                    in_roi = (circy >= roi[0]) & (circy < roi[1]) & (circx >= roi[2]) & (circx < roi[3])
+                    accum[circy[in_roi] - roi[0], circx[in_roi] - roi[2]] = 0
 
     return bub_dict
 
-def BubbleFinder(ev, num_pix_in_neighborhood = 20, noise_thresh = 10):
-    
-    out = _new_bub_dict()
-    out = FindBubbles(ev, 1, num_pix_in_neighborhood, noise_thresh, bub_dict=out)
-    out = FindBubbles(ev, 2, num_pix_in_neighborhood, noise_thresh, bub_dict=out)
-    out = FindBubbles(ev, 3, num_pix_in_neighborhood, noise_thresh, bub_dict=out)
+def BubbleFinder(ev, num_pix_in_neighborhood = 20, noise_thresh = 10, njob=1):
+    # njob: if > 1, the cameras are processed concurrently on a pool of njob threads. Each camera
+    #   fills its own bubble dictionary, and these are then merged in camera order with bub_num
+    #   renumbered, so the output is the same as processing the cameras one after the other
+    cams = [1, 2, 3]
+    if njob <= 1:
+        out = _new_bub_dict()
+        for cam in cams:
+            out = FindBubbles(ev, cam, num_pix_in_neighborhood, noise_thresh, bub_dict=out)
+        return out
 
+    with ThreadPoolExecutor(max_workers=min(njob, len(cams))) as pool:
+        futures = [pool.submit(FindBubbles, ev, cam, num_pix_in_neighborhood, noise_thresh) for cam in cams]
+        cam_dicts = [f.result() for f in futures]
+
+    out = _new_bub_dict()
+    for cam_dict in cam_dicts:
+        for key in bub_dict_keys:
+            out[key] += cam_dict[key]
+    # bubbles are numbered by their row in the output
+    out["bub_num"] = [[bub_num] for bub_num in range(len(out["bub_num"]))]
     return out
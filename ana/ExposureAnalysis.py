@@ -2,6 +2,8 @@
 
 import numpy as np
 
+from GetEvent import IterRun
+
 PTs = [2121, 1101]
 
 def exposure(PT, time, bins):
@@ -32,3 +34,119 @@ def ExposureAnalysis(ev, pressure_bins=np.linspace(0, 10, 201), PTs=PTs):
         output["PT%i_livetime" % PT] = T
 
     return output
+
+def exposure_segments(PT, time, bounds, bins):
+    # Run-level version of exposure: the pressure and livetime of every segment PT[bounds[i]:bounds[i+1]],
+    # with a single bincount histogram over all segments at once.
+    # Inputs:
+    #   PT, time: Concatenated slow_daq pressure and time_ms streams of all events
+    #   bounds: Segment boundaries into PT and time, one more than the number of segments
+    #   bins: Pressure histogram bin edges
+    # Outputs: (pressure, livetime) arrays, one entry per segment
+    bins = np.asarray(bins, dtype=np.float64)
+    bounds = np.asarray(bounds, dtype=np.intp)
+    PT = np.asarray(PT, dtype=np.float64)[bounds[0]:bounds[-1]]
+    time = np.asarray(time, dtype=np.float64)[bounds[0]:bounds[-1]]
+    nseg = len(bounds) - 1
+    nbins = len(bins) - 1
+    centers = (bins[1:] + bins[:-1])/2
+    lengths = np.diff(bounds)
+    nonempty = lengths > 0
+    starts = (bounds[:-1] - bounds[0])[nonempty]
+
+    # bin the samples like np.histogram: half-open bins, except the last one includes its upper edge.
+    # Samples outside the bins (or NaN) go to an extra bin nbins, which is dropped
+    inrange = (PT >= bins[0]) & (PT <= bins[-1])
+    if np.allclose(np.diff(bins), (bins[-1] - bins[0])/nbins):
+        # evenly spaced bins: compute the bin, then correct it against the actual edges for round-off
+        ibin = ((np.where(inrange, PT, bins[0]) - bins[0])*(nbins/(bins[-1] - bins[0]))).astype(np.intp)
+        np.minimum(ibin, nbins - 1, out=ibin)
+        ibin -= PT < bins[ibin]
+        ibin += (PT >= bins[ibin + 1]) & (ibin != nbins - 1)
+    else:
+        ibin = np.minimum(np.searchsorted(bins, PT, side="right") - 1, nbins - 1)
+    ibin[~inrange] = nbins
+    ibin += np.repeat(np.arange(nseg)*(nbins + 1), lengths)
+    binned = np.bincount(ibin, minlength=nseg*(nbins + 1)).reshape(nseg, nbins + 1)[:, :nbins]
+    below = PT < np.repeat(centers[np.argmax(binned, axis=1)], lengths)
+
+    # mean pressure below the mode, NaN if there is none (like np.mean of an empty selection)
+    nbelow = np.zeros(nseg, dtype=np.intp)
+    psum = np.zeros(nseg)
+    if len(starts):
+        nbelow[nonempty] = np.add.reduceat(below, starts, dtype=np.intp)
+        psum[nonempty] = np.add.reduceat(np.where(below, PT, 0.), starts)
+    with np.errstate(invalid="ignore"):
+        pressure = psum/nbelow
+
+    # the time differences between the samples below the mode add up to the last minus the first of them
+    ibelow = np.flatnonzero(below)
+    first = np.cumsum(nbelow) - nbelow
+    has = nbelow > 1
+    livetime = np.zeros(nseg)
+    livetime[has] = time[ibelow[first[has] + nbelow[has] - 1]] - time[ibelow[first[has]]]
+
+    return pressure, livetime/1e3
+
+def LoadRunSlowDAQ(rundir, events=None, PTs=PTs, prefetch=2):
+    # Loads only the event_info and slow_daq of the events of a run, and concatenates their slow_daq streams
+    # Inputs:
+    #   rundir: Location of raw data
+    #   events: Event numbers to load. Defaults to every event in the run
+    #   PTs: Pressure transducers to keep
+    # Outputs: (events, loaded, slow_daq, bounds), where
+    #   loaded: For each event, True if both its event_info and slow_daq were loaded
+    #   slow_daq: Dictionary of concatenated time_ms and PT streams
+    #   bounds: Event boundaries into the streams. Events that were not loaded get empty segments
+    keys = ["time_ms"] + ["PT%i" % PT for PT in PTs]
+    loaded_evs = {}
+    for ev, data in IterRun(rundir, "event_info", "slow_daq", events=events, prefetch=prefetch,
+                            strictMode=False, skip_errors=True):
+        if data["event_info"]["loaded"] and data["slow_daq"]["loaded"]:
+            loaded_evs[ev] = [np.asarray(data["slow_daq"][k], dtype=np.float64).ravel() for k in keys]
+        del data
+
+    if events is None:
+        events = sorted(loaded_evs)
+    events = np.asarray(events, dtype=np.intp)
+    loaded = np.array([ev in loaded_evs for ev in events], dtype=bool)
+    streams = [loaded_evs[ev] for ev in events if ev in loaded_evs]
+    lengths = np.zeros(len(events), dtype=np.intp)
+    lengths[loaded] = [len(s[0]) for s in streams]
+    bounds = np.concatenate([[0], np.cumsum(lengths)])
+    slow_daq = dict([(k, np.concatenate([s[i] for s in streams]) if streams else np.zeros(0))
+                     for i, k in enumerate(keys)])
+    return events, loaded, slow_daq, bounds
+
+def RunExposureAnalysis(slow_daq, bounds, pressure_bins=np.linspace(0, 10, 201), PTs=PTs, block=2**16):
+    # Exposure of every event of a run in one vectorised pass
+    # Inputs:
+    #   slow_daq: Dictionary of the concatenated time_ms and PT streams of all events (see LoadRunSlowDAQ)
+    #   bounds: Event boundaries into the streams
+    #   block: Events are processed in blocks of about this many samples, which keeps the temporaries in cache
+    # Outputs: The outputs of ExposureAnalysis, as arrays with one entry per event
+    bounds = np.asarray(bounds, dtype=np.intp)
+    nev = len(bounds) - 1
+    output = {}
+    for PT in PTs:
+        output["PT%i_pressure" % PT] = np.zeros(nev)
+        output["PT%i_livetime" % PT] = np.zeros(nev)
+
+    start = 0
+    while start < nev:
+        end = min(max(np.searchsorted(bounds, bounds[start] + block, side="right") - 1, start + 1), nev)
+        for PT in PTs:
+            P, T = exposure_segments(slow_daq["PT%i" % PT], slow_daq["time_ms"], bounds[start:end + 1], pressure_bins)
+            output["PT%i_pressure" % PT][start:end] = P
+            output["PT%i_livetime" % PT][start:end] = T
+        start = end
+
+    return output
+
+def ExposureAnalysisRun(rundir, events=None, pressure_bins=np.linspace(0, 10, 201), PTs=PTs, prefetch=2):
+    # Run-level mode of ExposureAnalysis: loads only the event_info and slow_daq of every event and
+    # computes the exposure of all of them at once, without the other subsystems
+    # Outputs: (events, loaded, output), where output holds the ExposureAnalysis outputs as arrays with one
+    #          entry per event. Only the entries of events that were loaded are meaningful
+    events, loaded, slow_daq, bounds = LoadRunSlowDAQ(rundir, events, PTs=PTs, prefetch=prefetch)
+    return events, loaded, RunExposureAnalysis(slow_daq, bounds, pressure_bins=pressure_bins, PTs=PTs)
@@ -0,0 +1,33 @@
+import numpy as np
+import scipy.signal
+
+# Butterworth filters as second-order sections, by (order, band, fs, btype), so each filter is designed once per process
+_filters = {}
+
+def ClipBand(band, fs, margin=1e-4):
+    # Keep cutoff frequencies strictly between 0 and the Nyquist frequency fs/2, which butter requires.
+    # Cutoffs outside are moved to margin (as a fraction of Nyquist) from the edge
+    nyq = fs/2.0
+    return np.clip(np.float64(band), margin*nyq, (1 - margin)*nyq)
+
+def GetSOS(order, band, fs, btype="bandpass"):
+    # Inputs:
+    #   order: Order of the Butterworth filter
+    #   band: Cutoff frequency in Hz, or [low, high] for band filters
+    #   fs: Sample rate in Hz
+    #   btype: "bandpass", "bandstop", "lowpass" or "highpass"
+    # Outputs: The cached second-order sections. They are shared by every caller, so do not modify them
+    band = tuple(np.atleast_1d(np.float64(band)).tolist())
+    key = (int(order), band, float(fs), btype)
+    if key not in _filters:
+        _filters[key] = scipy.signal.butter(int(order), band if len(band) > 1 else band[0],
+                                            btype=btype, fs=float(fs), output="sos")
+    return _filters[key]
+
+def Filter(yd, order, band, fs, btype="bandpass", axis=-1, zero_phase=True):
+    # Filters yd along axis, so a stack of waveforms is filtered in one call.
+    # zero_phase runs the filter forwards and backwards (sosfiltfilt), otherwise it is causal (sosfilt)
+    sos = GetSOS(order, band, fs, btype=btype)
+    if zero_phase:
+        return scipy.signal.sosfiltfilt(sos, yd, axis=axis)
+    return scipy.signal.sosfilt(sos, yd, axis=axis)
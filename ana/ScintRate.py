@@ -35,16 +35,22 @@ def ScintillationRateAnalysis(ev):
     }
     if ev is None or not ev['event_info']['loaded'] or not ev['scintillation']['loaded']:
         print("File not loaded. Quitting.")
+        if ev is not None and ev['scintillation']['loaded'] and hasattr(ev['scintillation']['Waveforms'], "shape"):
+            # One default row per trigger in the batch, since the outputs are declared per trigger (see below)
+            ntrig = ev['scintillation']['Waveforms'].shape[0]
+            output = dict([(k, np.zeros((ntrig,) + v.shape[1:], dtype=v.dtype)) for (k, v) in output.items()])
         return output
 
     # Load the waveforms
     waveforms = ev["scintillation"]['Waveforms']
-    # Remove non-functional SiPMs
-    nonfunctional_sipms = [24, 31]
-    waveforms[:, nonfunctional_sipms, :] = 0
     
     signal_ratio = _signal_ratio_filtering(waveforms)
 
+    # Remove non-functional SiPMs. Done on the ratio rather than by zeroing the waveforms,
+    # so that the input is left untouched for other analyses sharing the same batch
+    nonfunctional_sipms = [24, 31]
+    signal_ratio[:, nonfunctional_sipms] = 0
+
     # Find all signals with a ratio of peak to baseline > 3, these should be good pulses.
     signal_ratio_limit = 3.
     mask = signal_ratio >= signal_ratio_limit
@@ -59,6 +65,9 @@ def ScintillationRateAnalysis(ev):
 
     return output
 
+# Outputs with one row per trigger, for BatchSiPMs
+ScintillationRateAnalysis.per_trigger_outputs = ("n_hits", "hits_mask")
+
 # The rest of this code can be used in a jupyter notebook to see the results. 
 if __name__ == "__main__":
     # from GetEvent import GetEvent
@@ -10,10 +10,13 @@ from scipy import stats
 import json
 
 from scipy.fft import fft, fftfreq
-from scipy.signal import find_peaks
+from scipy.signal import find_peaks, lfilter
 from scipy.stats import norm
 
+from multiprocess import Pool
+
 from ana  import BatchSiPMs
+from ana import ADCCalibration
 
 SAMPLE_FREQ = 62.5 # MHz
 
@@ -22,20 +25,21 @@ SAMPLE_FREQ = 62.5 # MHz
 #This function just removes the droop, as written by Ben. Runs on a single trace
 def droopFix(data, droop_tau=150,  # still just a guess
       t0=80):
-    droop_A = droop_tau * (1-np.exp(-1./droop_tau))
-    wf_corr = np.zeros(np.size(data))
-    S = np.zeros(np.size(data)) # recursive correction factor
-    for i in range(np.size(data)):
-        if i < t0: # handles pre-trigger
-            S[i] = 0
-            wf_corr[i] = data[i]
-        elif i == t0: # acquisition t0
-            S[i] = 0
-            wf_corr[i] = data[i]/droop_A
-        else:
-            S[i] = wf_corr[i-1] + np.exp(-1/droop_tau)*S[i-1]
-            wf_corr[i] = data[i]/droop_A + (droop_A/droop_tau)*S[i]
-    return(wf_corr)
+    return droopFixBatched(np.asarray(data, dtype=float), droop_tau, t0)
+
+#Droop correction of any number of traces at once, along the sample axis. Ben's recursion
+#  S[i] = wf_corr[i-1] + exp(-1/tau)*S[i-1], wf_corr[i] = data[i]/A + (A/tau)*S[i]
+#starting at t0 with S[t0] = 0 is the IIR filter
+#  wf_corr[i] = x[i] - exp(-1/tau)*x[i-1] + (exp(-1/tau) + A/tau)*wf_corr[i-1], x = data/A
+#so it is run with lfilter. The pre-trigger samples are left as they are
+def droopFixBatched(data, droop_tau=150, t0=80, axis=-1):
+    decay = np.exp(-1./droop_tau)
+    droop_A = droop_tau * (1-decay)
+    data = np.moveaxis(np.asarray(data), axis, -1)
+    wf_corr = np.array(data, dtype=float)
+    if t0 < wf_corr.shape[-1]:
+        wf_corr[..., t0:] = lfilter([1, -decay], [1, -(decay + droop_A/droop_tau)], data[..., t0:]/droop_A, axis=-1)
+    return np.moveaxis(wf_corr, -1, axis)
 
 #This is the denoising written by Gary Sweeney, runs on a single trace
 def fft_denoise(signal, dt, cutoff_freq):
@@ -50,19 +54,152 @@ def fft_denoise(signal, dt, cutoff_freq):
     denoised_signal = np.fft.ifft(filtered_fft).real
     return denoised_signal, freqs, np.abs(fft_vals), np.abs(filtered_fft)
 
+#Same low-pass FFT mask as fft_denoise, applied to any number of traces at once along the sample axis.
+#The mask is symmetric in frequency, so the real FFT gives the same denoised signal
+def fft_denoise_batched(signals, dt, cutoff_freq, axis=-1):
+    N = np.shape(signals)[axis]
+    mask = np.abs(np.fft.rfftfreq(N, dt)) <= cutoff_freq
+    shape = [1]*np.ndim(signals)
+    shape[axis] = mask.size
+    return np.fft.irfft(np.fft.rfft(signals, axis=axis)*mask.reshape(shape), n=N, axis=axis)
+
 #This is the function being used now, which seems to work well
 def newFitFunc(t,*p): #time, and fit parameters (length that is dependent on number of pulses)
-    # length of p (e.g. initial_guess) will tell us how many pulses to fit
-    n = int(np.size(p)/5) #number of pulses to fit
-    splitInput = np.array_split(np.array(p),n)  #splits the input p into n arrays of the components for each fit
+    # length of p (e.g. initial_guess) will tell us how many pulses to fit, 5 parameters each
     # nEXO SiPM pulse template, but with k = 0. arXiv:1903.03663
     # p[0] -> t0, p[1] -> pulse area (eventually proportional to nPE), p[2] -> baseline
     # p[3] -> tau_s (fall time), p[4] -> tau_r (rise time)
-    f = np.heaviside((t-splitInput[0][0]),0.5)*splitInput[0][1]*(1/splitInput[0][3]*(np.exp(-(t-splitInput[0][0])/(splitInput[0][3]+splitInput[0][4])) - np.exp(-(t-splitInput[0][0])/(splitInput[0][4]))))
-    if n>0:
-        for i in range(1,n):
-            f += np.heaviside((t-splitInput[i][0]),0.5)*splitInput[i][1]*(1/splitInput[i][3]*(np.exp(-(t-splitInput[i][0])/(splitInput[i][3]+splitInput[i][4])) - np.exp(-(t-splitInput[i][0])/(splitInput[i][4]))))
-    return f  # f is now a sum of n calls of the single-pulse function
+    return pulseTemplate(np.asarray(t), np.reshape(p, (-1, 5)), jac=False)  # f is a sum of n single-pulse functions
+
+#Derivatives of newFitFunc with respect to each parameter, shape (len(t), len(p)), for curve_fit(jac=...)
+def newFitJac(t,*p):
+    _, J = pulseTemplate(np.asarray(t), np.reshape(p, (-1, 5)))
+    return J.reshape((-1, J.shape[-1])).T
+
+#The template of newFitFunc and its closed-form Jacobian, for any number of traces at once
+#Inputs:
+#  t: times, shape (T,)
+#  p: parameters, shape (..., n pulses, 5)
+#Outputs: the sum over pulses, shape (..., T), and if jac its derivatives, shape (..., n pulses, 5, T).
+#  The baseline parameter is not part of the template, so its derivative is 0
+def pulseTemplate(t, p, jac=True):
+    t0, A, tau_s, tau_r = [p[..., k, None] for k in (0, 1, 3, 4)]
+    u = t - t0
+    step = np.heaviside(u, 0.5)
+    u = np.maximum(u, 0) # the template is 0 before t0, so keep the exponentials from blowing up there
+    tau_sr = tau_s + tau_r
+    E_sr = np.exp(-u/tau_sr)
+    E_r = np.exp(-u/tau_r)
+    f = step*A*(1/tau_s*(E_sr - E_r))
+    model = f.sum(axis=-2)
+    if not jac:
+        return model
+    J = np.zeros(p.shape + t.shape)
+    J[..., 0, :] = step*A/tau_s*(E_sr/tau_sr - E_r/tau_r)
+    J[..., 1, :] = step/tau_s*(E_sr - E_r)
+    J[..., 3, :] = -f/tau_s + step*A/tau_s*E_sr*u/tau_sr**2
+    J[..., 4, :] = step*A/tau_s*(E_sr*u/tau_sr**2 - E_r*u/tau_r**2)
+    return model, J
+
+# Fitting engine
+
+#Fits newFitFunc to many traces at once, with a bounded Levenberg-Marquardt solver using the
+#closed-form Jacobian of pulseTemplate. All traces in one call share the time grid and the
+#number of pulses, so each iteration is a handful of array operations on the whole batch
+class MultiPulseFitter:
+    def __init__(self, numSamples, sample_to_us, max_iter=200, ftol=1e-8, xtol=1e-8, chunk=1024):
+        # chunk: maximum number of traces solved together, which bounds the Jacobian memory
+        self.t = np.arange(numSamples)*sample_to_us
+        self.max_iter = max_iter
+        self.ftol = ftol
+        self.xtol = xtol
+        self.chunk = chunk
+
+    def fit(self, wfs, wfErrs, p0, lower, upper, return_cov=False):
+        # Inputs:
+        #   wfs, wfErrs: traces and their uncertainties, shape (K, T)
+        #   p0, lower, upper: initial guesses and bounds, shape (K, 5*n pulses)
+        #   return_cov: Also compute the parameter covariances
+        # Outputs: (popt, shape (K, 5*n), converged, shape (K,)), or with return_cov
+        #   (popt, pcov, shape (K, 5*n, 5*n), converged). pcov is scaled by the reduced chi-square,
+        #   as in curve_fit. Traces that did not converge (including fits that stalled with every
+        #   step rejected), or have non-finite inputs, are flagged in converged
+        wfs, wfErrs = np.asarray(wfs, dtype=float), np.asarray(wfErrs, dtype=float)
+        p0, lower, upper = [np.array(x, dtype=float, ndmin=2) for x in (p0, lower, upper)]
+        K, npar = p0.shape
+        popt = np.full((K, npar), np.nan)
+        pcov = np.full((K, npar, npar), np.inf) if return_cov else None
+        converged = np.zeros(K, dtype=bool)
+        for start in range(0, K, self.chunk):
+            sl = slice(start, min(start + self.chunk, K))
+            popt[sl], cov, converged[sl] = self._fit(wfs[sl], wfErrs[sl], p0[sl], lower[sl], upper[sl], return_cov)
+            if return_cov:
+                pcov[sl] = cov
+        if return_cov:
+            return popt, pcov, converged
+        return popt, converged
+
+    def _residuals(self, p, wfs, weights, jac=True):
+        out = pulseTemplate(self.t, p.reshape((p.shape[0], -1, 5)), jac=jac)
+        if not jac:
+            return (wfs - out)*weights
+        model, J = out
+        return (wfs - model)*weights, J.reshape((p.shape[0], p.shape[1], -1))*weights[:, None, :]
+
+    def _fit(self, wfs, wfErrs, p0, lower, upper, return_cov=False):
+        K, npar = p0.shape
+        p = np.clip(p0, lower, upper)
+        weights = 1/wfErrs
+        finite = np.all(np.isfinite(wfs) & np.isfinite(weights), axis=1) & np.all(np.isfinite(p), axis=1)
+        wfs, weights = np.where(finite[:, None], wfs, 0), np.where(finite[:, None], weights, 0)
+        p[~finite] = np.clip(0, lower, upper)[~finite]
+
+        cost = np.sum(self._residuals(p, wfs, weights, jac=False)**2, axis=1)
+        lam = np.full(K, 1e-3)
+        active = finite.copy()
+        stalled = np.zeros(K, dtype=bool)
+        for _ in range(self.max_iter):
+            idx = np.flatnonzero(active)
+            if idx.size == 0:
+                break
+            r, J = self._residuals(p[idx], wfs[idx], weights[idx])
+            JTJ = J @ J.transpose((0, 2, 1))
+            g = J @ r[..., None]
+            # parameters at a bound that the step would push further out are held there
+            held = ((p[idx] <= lower[idx]) & (g[..., 0] < 0)) | ((p[idx] >= upper[idx]) & (g[..., 0] > 0))
+            JTJ[held[:, :, None] | held[:, None, :]] = 0
+            g[held] = 0
+            D = np.diagonal(JTJ, axis1=1, axis2=2).copy()
+            D[D <= 0] = 1 # parameters the template does not depend on get no step
+            A = JTJ + lam[idx, None, None]*D[:, :, None]*np.eye(npar)
+            p_new = np.clip(p[idx] + np.linalg.solve(A, g)[..., 0], lower[idx], upper[idx])
+            cost_new = np.sum(self._residuals(p_new, wfs[idx], weights[idx], jac=False)**2, axis=1)
+
+            better = cost_new < cost[idx]
+            dcost = np.where(better, cost[idx] - cost_new, 0)
+            dp = np.abs(p_new - p[idx])
+            p[idx[better]] = p_new[better]
+            cost[idx[better]] = cost_new[better]
+            lam[idx] = np.where(better, lam[idx]/10, lam[idx]*10)
+
+            # converged on an accepted step that barely changed the cost or the parameters. (Rejected steps
+            # also get small as lam grows, so they say nothing about convergence)
+            done = better & ((dcost <= self.ftol*cost[idx]) | np.all(dp <= self.xtol*(self.xtol + np.abs(p[idx])), axis=1))
+            # every step rejected until the damping blew up: give up on the trace, as a failed fit
+            stuck = ~done & (lam[idx] > 1e16)
+            stalled[idx[stuck]] = True
+            active[idx[done | stuck]] = False
+
+        converged = finite & ~active & ~stalled
+        p[~converged] = np.nan
+        if not return_cov:
+            return p, None, converged
+        pcov = np.full((K, npar, npar), np.inf)
+        if np.any(converged):
+            _, J = self._residuals(p[converged], wfs[converged], weights[converged])
+            dof = max(wfs.shape[1] - npar, 1)
+            pcov[converged] = np.linalg.pinv(J @ J.transpose((0, 2, 1)))*(cost[converged]/dof)[:, None, None]
+        return p, pcov, converged
 
 # L2 functions
 
@@ -70,38 +207,28 @@ def newFitFunc(t,*p): #time, and fit parameters (length that is dependent on num
 ################
 #This is the collection of functions that takes in the waveforms
 #and outputs the transfomred waveforms and error
-def prepareWaveforms(wfs, t0):
-    range_V = 2 # from json
+def prepareWaveforms(wfs, t0, calibration=None):
+    # calibration: ADCCalibration of the run, for the per-channel range. Without it, assume 2 Vpp
+    # All traces are processed at once, as [#events,#sipms,#samples] arrays
+    range_V = 2
     dt = 16 # 1 sample = 16 ns (CAEN samples at 62.5 MHz), from json?
     cutoff = 0.005 # Cutoff at 200 MHz
-    numEvents = np.shape(wfs)[0]
     numSipms = np.shape(wfs)[1]
-    numSamples = np.shape(wfs)[2]
-    #print('prepareWaveforms numEvents:',numEvents)
-    #print('prepareWaveforms numSipms:',numSipms)
-    wfFinal = []
-    wfErrFinal = []
-    #Start something to give uncertainty on these values
-    for ev in range(numEvents):
-        wfEvent = []
-        wfErrEvent = []
-        for sipm in range(numSipms):
-            wfErr = np.ones(numSamples)
-            #Transform both the waveform and uncertainty to mV
-            wf =  wfs[ev][sipm]*range_V/np.power(2,12)*1000
-            wfErr*=(range_V/np.power(2,12)*1000)/wf
-            # FFT filtering rom Gary:
-            denoised_waveform, freqs, fft_raw, fft_filtered = fft_denoise(wf, dt=dt, cutoff_freq=cutoff)
-            wf = denoised_waveform
-            wfErr*=wf
-            # Do some baseline noise calculations
-            baseline = np.mean(wf[:t0])
-            wf = -1*(wf - baseline)
-            wfEvent.append(wf)
-            wfErrEvent.append(wfErr)
-        wfFinal.append(wfEvent)
-        wfErrFinal.append(wfErrEvent)
-    return(wfFinal,wfErrFinal)
+    if calibration is not None:
+        mV_per_count = calibration.mV_per_count(numSipms)
+    else:
+        mV_per_count = np.full(numSipms, range_V/np.power(2,12)*1000)
+    mV_per_count = mV_per_count.reshape((1, numSipms, 1))
+    #Transform both the waveform and uncertainty to mV
+    wf = wfs*mV_per_count
+    wfErr = mV_per_count/wf
+    # FFT filtering rom Gary:
+    wf = fft_denoise_batched(wf, dt=dt, cutoff_freq=cutoff)
+    wfErr = wfErr*wf
+    # Do some baseline noise calculations
+    baseline = np.mean(wf[:, :, :t0], axis=-1, keepdims=True)
+    wf = -1*(wf - baseline)
+    return(wf,wfErr)
 
 ##########
 ################
@@ -140,91 +267,155 @@ def tagCoincidentEvents(adjWfs):
 ################
 ##########
 
-#This is the function that does most of the work of fitting
+#Initial guess and bounds of the fit parameters, from the peaks found in the droop corrected wf
+#Returns (peaks, initial_guess, bounds), or None if there are no peaks
+#max_pulses: number of peaks to fit, in order of time. Only the first one is fit for now
+def fitGuess(wf, wf_corr, sample_to_us, t0, max_pulses=1):
+    baseline = np.mean(wf[:t0])
+    baselineRMS = np.sqrt(np.mean((wf[:50])**2))
+    #find number of peaks. maybe need to try this, then if chi square fails, iterate about n_found
+    peaks, properties = find_peaks(wf_corr,height = 6*baselineRMS, distance=15, width=10) #Ken originally had w=3
+    #print('peaks, heights:',peaks, properties['peak_heights'])
+    if len(peaks) == 0:
+        return None
+    #construct initial guess and bounds arrays
+    initial_guess = []
+    boundsLower = []
+    boundsUpper = []
+    for i in range(min(len(peaks), max_pulses)):
+        initial_guess += [peaks[i]*sample_to_us,properties['peak_heights'][i],baseline,0.001*sample_to_us,10*sample_to_us]
+        boundsLower += [peaks[i]*sample_to_us-0.25,0,-0.1,0.001*sample_to_us*0.1,10*sample_to_us*0.1]
+        boundsUpper += [peaks[i]*sample_to_us+0.25,100*properties['peak_heights'][i],0.1,0.001*sample_to_us*10,10*sample_to_us*10]
+    return peaks, np.array(initial_guess), np.array([boundsLower,boundsUpper])
+
+#Chi-square of the fit and manual integral of the first pulse in wf_corr
+def fitSummary(wf, wf_corr, wfErr, t_obs, popt, peaks, sample_to_us):
+    #Let's calculate the chi-squared value for this fit
+    modelY = newFitFunc(t_obs,*popt)
+    residY = np.sum(((wf_corr-modelY)/wfErr)**2)
+    chiSq = residY/(len(wf)-5)
+
+    # Manual integration - maybe we can remove this now.
+    #It would be good to get a rough idea of the integral done manually
+    lowerBound=peaks[0]
+    upperBound=peaks[0]
+    intPulse=0
+    for j in range(peaks[0]-3):
+        if not(wf_corr[peaks[0]-j]>wf_corr[peaks[0]-(j+1)] and wf_corr[peaks[0]-(j+1)]>wf_corr[peaks[0]-(j+2)] and wf_corr[peaks[0]-(j+2)]>wf_corr[peaks[0]-(j+3)]):
+            lowerBound=peaks[0]-(j+3)
+            #print('Found lower edge -',times[peaks[0]-(j+3)])
+            break
+    for j in range(len(wf_corr)-(peaks[0]+4)):
+        if not(wf_corr[peaks[0]+j]>wf_corr[peaks[0]+(j+1)] and wf_corr[peaks[0]+(j+1)]>wf_corr[peaks[0]+(j+2)] and wf_corr[peaks[0]+(j+2)]>wf_corr[peaks[0]+(j+3)]):
+            upperBound=peaks[0]+(j+3)
+            #print('Found upper edge -',times[peaks[0]+(j+3)])
+            break
+    for j in range(upperBound-lowerBound):
+        #print(wf_corr[lowerBound+j])
+        intPulse+=wf_corr[lowerBound+j]
+    return chiSq, intPulse*sample_to_us
+
+#This is the function that does most of the work of fitting a single trace
 #as well as the droop correction
-def fitPulse(wf, wfErr, sample_to_us, t0):
+#wf_corr: droop corrected wf, if already computed for many traces at once with droopFixBatched
+def fitPulse(wf, wfErr, sample_to_us, t0, wf_corr=None):
     #First convert the time (in samples) to ns
     t_obs = np.where(wf==wf)[0]*sample_to_us
-    baseline = np.mean(wf[:t0])
-    baselineRMS = np.sqrt(np.mean((wf[:50])**2))
-    peakBin = np.argmax(wf)
-    peak = np.max(wf) #ADC value of peak
-    noiseThreshold = 4.5
-    initial_guess = np.array([])
-
-
-    wf_corr = droopFix(wf)
-   
-    '''
-    # Droop correction
-    droop_tau = 150 # a guess
-    droop_A = droop_tau * (1-np.exp(-1./droop_tau))
-    S = np.zeros(np.size(wf)) # recursive correction factor
-    wf_corr = np.zeros(np.size(wf))
-    for i in range(np.size(wf)):
-        if i < 80: # handles pre-trigger
-            S[i] = 0
-            wf_corr[i] = wf[i]
-        elif i == 80: # acquisition t0
-            S[i] = 0
-            wf_corr[i] = wf[i]/droop_A
-        else:
-            S[i] = wf_corr[i-1] + np.exp(-1/droop_tau)*S[i-1]
-            wf_corr[i] = wf[i]/droop_A + (droop_A/droop_tau)*S[i]
-'''
 
-            
+    if wf_corr is None:
+        wf_corr = droopFix(wf)
+
     try:
-        #find number of peaks. maybe need to try this, then if chi square fails, iterate about n_found
-        peaks, properties = find_peaks(wf_corr,height = 6*baselineRMS, distance=15, width=10) #Ken originally had w=3
-        #print('peaks, heights:',peaks, properties['peak_heights'])
-        #construct initial guess and bounds arrays
-        #may need to cover the scenario where there is no fit, but popt3 is held over from the previous event
-        for i in range(len(peaks)):
-            if i==0:
-                initial_guess = [peaks[0]*sample_to_us,properties['peak_heights'][0],baseline,0.001*sample_to_us,10*sample_to_us]
-                boundsLower = [peaks[0]*sample_to_us-0.25,0,-0.1,0.001*sample_to_us*0.1,10*sample_to_us*0.1]
-                boundsUpper = [peaks[0]*sample_to_us+0.25,100*properties['peak_heights'][0],0.1,0.001*sample_to_us*10,10*sample_to_us*10]
-            else:
-                initial_guess = np.append(initial_guess, [peaks[i]*sample_to_us,properties['peak_heights'][i],baseline,0.001*sample_to_us,10*sample_to_us])
-                boundsLower = np.append(boundsLower,[peaks[i]*sample_to_us-0.25,0,-0.1,0.001*sample_to_us*0.1,10*sample_to_us*0.1] )
-                boundsUpper = np.append(boundsUpper,[peaks[i]*sample_to_us+0.25,100*properties['peak_heights'][i],0.1,0.001*sample_to_us*10,10*sample_to_us*10])
-            bounds = np.array([boundsLower,boundsUpper])
-            #print(bounds)
-            # perform the fit
-            popt1, pcov1 = scipy.optimize.curve_fit(newFitFunc, t_obs, wf_corr, p0=initial_guess, bounds=bounds, sigma=wfErr)
-            #Let's calculate the chi-squared value for this fit
-            modelY = newFitFunc(t_obs,*popt1)
-            residY = np.sum(((wf_corr-modelY)/wfErr)**2)
-            chiSq = residY/(len(wf)-5)
-
-            # Manual integration - maybe we can remove this now.
-            #It would be good to get a rough idea of the integral done manually
-            lowerBound=peaks[0]
-            upperBound=peaks[0]
-            intPulse=0
-            for j in range(peaks[0]-3):
-                if not(wf_corr[peaks[0]-j]>wf_corr[peaks[0]-(j+1)] and wf_corr[peaks[0]-(j+1)]>wf_corr[peaks[0]-(j+2)] and wf_corr[peaks[0]-(j+2)]>wf_corr[peaks[0]-(j+3)]):
-                    lowerBound=peaks[0]-(j+3)
-                    #print('Found lower edge -',times[peaks[0]-(j+3)])
-                    break
-            for j in range(len(wf_corr)-(peaks[0]+4)):
-                if not(wf_corr[peaks[0]+j]>wf_corr[peaks[0]+(j+1)] and wf_corr[peaks[0]+(j+1)]>wf_corr[peaks[0]+(j+2)] and wf_corr[peaks[0]+(j+2)]>wf_corr[peaks[0]+(j+3)]):
-                    upperBound=peaks[0]+(j+3)
-                    #print('Found upper edge -',times[peaks[0]+(j+3)])
-                    break
-            for j in range(upperBound-lowerBound):
-                #print(wf_corr[lowerBound+j])
-                intPulse+=wf_corr[lowerBound+j]
-            return popt1, pcov1, wf_corr, wfErr, t_obs, chiSq, intPulse*sample_to_us
-        else:
+        guess = fitGuess(wf, wf_corr, sample_to_us, t0)
+        if guess is None:
             return [-1000,-1000,-1000,-1000,-1000], [np.inf,np.inf,np.inf],wf_corr, t_obs, -100, 100, -100
+        peaks, initial_guess, bounds = guess
+        # perform the fit
+        popt1, pcov1 = scipy.optimize.curve_fit(newFitFunc, t_obs, wf_corr, p0=initial_guess, bounds=bounds, sigma=wfErr, jac=newFitJac)
+        chiSq, intPulse = fitSummary(wf, wf_corr, wfErr, t_obs, popt1, peaks, sample_to_us)
+        return popt1, pcov1, wf_corr, wfErr, t_obs, chiSq, intPulse
     except RuntimeError:
             return [-1000,-1000,-1000,-1000,-1000], [np.inf,np.inf,np.inf],wf_corr, t_obs, -100, 100, -100
     except ZeroDivisionError:
             return [-1000,-1000,-1000,-1000,-1000], [np.inf,np.inf,np.inf],wf_corr, t_obs, -100, 100, -100
 
-def getFitValues(ev, numEvToDo=-1, t0=80):
+#Fit all traces of adjWfs, as [#events,#sipms,#samples] arrays
+#Outputs: a list of (event, sipm, fit parameters, chiSq, intPulse), in (event, sipm) order
+#batch_fit: fit the traces together with MultiPulseFitter, grouped by number of pulses. Otherwise
+#  fit each trace with curve_fit in fitPulse
+def fitTraces(adjWfs, adjWfsErr, corrWfs, sample_to_us, t0, batch_fit=True):
+    numEvents, numSipms, numSamples = np.shape(adjWfs)
+    failed = ([-1000,-1000,-1000,-1000,-1000], 100, -100)
+    if not batch_fit:
+        results = []
+        for i in range(numEvents):
+            for j in range(numSipms):
+                fitParams, fitCov, denoisedWf, wfErr, times, chiSq, intPulse = fitPulse(adjWfs[i][j], adjWfsErr[i][j], sample_to_us, t0, corrWfs[i][j])
+                results.append((i, j, fitParams, chiSq, intPulse))
+        return results
+
+    t_obs = np.arange(numSamples)*sample_to_us
+    results = {}
+    guesses = {} # number of fit parameters -> list of (event, sipm, peaks, initial guess, bounds)
+    for i in range(numEvents):
+        for j in range(numSipms):
+            guess = fitGuess(adjWfs[i][j], corrWfs[i][j], sample_to_us, t0)
+            if guess is None:
+                results[(i, j)] = failed
+            else:
+                guesses.setdefault(len(guess[1]), []).append((i, j) + guess)
+
+    fitter = MultiPulseFitter(numSamples, sample_to_us)
+    for todo in guesses.values():
+        evs = np.array([g[0] for g in todo])
+        sipms = np.array([g[1] for g in todo])
+        popt, converged = fitter.fit(corrWfs[evs, sipms], adjWfsErr[evs, sipms],
+                                     np.array([g[3] for g in todo]),
+                                     np.array([g[4][0] for g in todo]), np.array([g[4][1] for g in todo]))
+        for k, (i, j, peaks, _, _) in enumerate(todo):
+            if not converged[k]:
+                results[(i, j)] = failed
+                continue
+            chiSq, intPulse = fitSummary(adjWfs[i][j], corrWfs[i][j], adjWfsErr[i][j], t_obs, popt[k], peaks, sample_to_us)
+            results[(i, j)] = (popt[k], chiSq, intPulse)
+    return [(i, j) + results[(i, j)] for i in range(numEvents) for j in range(numSipms)]
+
+# Per-process state of the parallel fit workers, set up once by _initFitWorker
+_fit_worker = {}
+
+def _initFitWorker(adjWfs, adjWfsErr, corrWfs, sample_to_us, t0, batch_fit):
+    numSamples = np.shape(adjWfs)[-1]
+    # traces are handed out by their index in (trigger, SiPM) order
+    _fit_worker["traces"] = [np.reshape(x, (-1, 1, numSamples)) for x in (adjWfs, adjWfsErr, corrWfs)]
+    _fit_worker["args"] = (sample_to_us, t0, batch_fit)
+    # Warm up with one fit of a clean pulse, so lazy imports and setup are done before the real work
+    t = np.arange(numSamples)*sample_to_us
+    pulse = newFitFunc(t, (t0 + 10)*sample_to_us, 100, 0, 0.001*sample_to_us, 10*sample_to_us).reshape((1, 1, -1))
+    fitTraces(pulse, np.ones_like(pulse), pulse, sample_to_us, t0, batch_fit)
+
+def _fitChunk(bounds):
+    start, end = bounds
+    adjWfs, adjWfsErr, corrWfs = [x[start:end] for x in _fit_worker["traces"]]
+    # each trace is its own event of one SiPM here, so return the trace index instead
+    return [(start + i, fitParams, chiSq, intPulse) for i, _, fitParams, chiSq, intPulse in fitTraces(adjWfs, adjWfsErr, corrWfs, *_fit_worker["args"])]
+
+#Like fitTraces, but with the traces spread over njob worker processes in chunks of chunk_size traces.
+#Outputs are in the same (event, sipm) order as fitTraces
+def fitTracesParallel(adjWfs, adjWfsErr, corrWfs, sample_to_us, t0, batch_fit=True, njob=2, chunk_size=256):
+    numEvents, numSipms, _ = np.shape(adjWfs)
+    ntrace = numEvents*numSipms
+    chunks = [(start, min(start + chunk_size, ntrace)) for start in range(0, ntrace, chunk_size)]
+    results = []
+    with Pool(processes=njob, initializer=_initFitWorker, initargs=(adjWfs, adjWfsErr, corrWfs, sample_to_us, t0, batch_fit)) as pool:
+        for chunk in pool.imap(_fitChunk, chunks):
+            for k, fitParams, chiSq, intPulse in chunk:
+                results.append((k // numSipms, k % numSipms, fitParams, chiSq, intPulse))
+    return results
+
+def getFitValues(ev, numEvToDo=-1, t0=80, batch_fit=True, fit_njob=1, chunk_size=256):
+    # batch_fit: see fitTraces
+    # fit_njob: number of processes to fit the traces with, chunk_size traces at a time (see fitTracesParallel).
+    #   Don't combine with njob > 1 in SiPMFitterBatched, worker processes cannot start their own pools
     if ev is None:
         return {
           "thit": np.array([]),
@@ -260,7 +451,9 @@ def getFitValues(ev, numEvToDo=-1, t0=80):
     #print('getFitValues numsSamples:',numSamples)
 
     #First let's remove the baseline and flip the pulses
-    adjWfs,adjWfsErr = prepareWaveforms(wfs, t0)
+    adjWfs,adjWfsErr = prepareWaveforms(wfs[:numEvents], t0, ADCCalibration.GetCalibration(ev.get("run_control"), numSipms))
+    #and remove the droop from all of them together
+    corrWfs = droopFixBatched(adjWfs)
 
     #Next let's do the simple test to sort out coincident events
     coincEvents = tagCoincidentEvents(adjWfs)
@@ -278,21 +471,23 @@ def getFitValues(ev, numEvToDo=-1, t0=80):
     sipmsCoinc = np.full((numSipms, numEvents), np.nan)
 
     #Now that those are set up, let's actually do this thing
-    for i in range(numEvents):
-        for j in range(numSipms):
-            fitParams, fitCov, denoisedWf, wfErr, times, chiSq, intPulse = fitPulse(adjWfs[i][j], adjWfsErr[i][j], sample_to_us, t0)
-            sipmsFitT0[j][i] = fitParams[0]
-            sipmsFitArea[j][i] = fitParams[1]
-            sipmsFitBaseline[j][i] = fitParams[2]
-            sipmsFitFallTime[j][i] = fitParams[3]
-            sipmsFitRiseTime[j][i] = fitParams[4]
-            sipmsManual[j][i] = intPulse
-            sipmsChiSq[j][i] = chiSq
-            sipmsEvNum[j][i] = i
-            if j in coincEvents[i]:
-                sipmsCoinc[j][i] = 1
-            else:
-                sipmsCoinc[j][i] = 0
+    if fit_njob > 1:
+        fits = fitTracesParallel(adjWfs, adjWfsErr, corrWfs, sample_to_us, t0, batch_fit, fit_njob, chunk_size)
+    else:
+        fits = fitTraces(adjWfs, adjWfsErr, corrWfs, sample_to_us, t0, batch_fit)
+    for i, j, fitParams, chiSq, intPulse in fits:
+        sipmsFitT0[j][i] = fitParams[0]
+        sipmsFitArea[j][i] = fitParams[1]
+        sipmsFitBaseline[j][i] = fitParams[2]
+        sipmsFitFallTime[j][i] = fitParams[3]
+        sipmsFitRiseTime[j][i] = fitParams[4]
+        sipmsManual[j][i] = intPulse
+        sipmsChiSq[j][i] = chiSq
+        sipmsEvNum[j][i] = i
+        if j in coincEvents[i]:
+            sipmsCoinc[j][i] = 1
+        else:
+            sipmsCoinc[j][i] = 0
 
     return {
       "thit": np.array(sipmsFitT0),
@@ -305,8 +500,11 @@ def getFitValues(ev, numEvToDo=-1, t0=80):
       "coinc": np.array(sipmsCoinc)
     }
 
-def SiPMFitterBatched(ev, t0=80, nwvf_batch=1000, maxwvf=0, progress=False, njob=1):
-    return BatchSiPMs.BatchSiPMs(ev, getFitValues, t0=t0, 
+# The outputs are (SiPM, trigger), so none of them has one row per trigger for BatchSiPMs
+getFitValues.per_trigger_outputs = ()
+
+def SiPMFitterBatched(ev, t0=80, nwvf_batch=1000, maxwvf=0, progress=False, njob=1, batch_fit=True, fit_njob=1, chunk_size=256):
+    return BatchSiPMs.BatchSiPMs(ev, getFitValues, t0=t0, batch_fit=batch_fit, fit_njob=fit_njob, chunk_size=chunk_size,
         nwvf_batch=nwvf_batch, maxwvf=maxwvf, progress=progress, njob=njob)
 
 
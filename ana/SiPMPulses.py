@@ -1,13 +1,16 @@
 import numpy as np
 from ana import BatchSiPMs
+from ana import ADCCalibration
 
 SAMPLE_FREQ = 62.5 # MHz
 
-def SiPMPulsesBatched(ev, nwvf_batch=1000, convert_adc2mV=False, smoothing=None, n_sigma_threshold=5, maxwvf=0, progress=False, njob=1):
+def SiPMPulsesBatched(ev, nwvf_batch=1000, convert_adc2mV=False, smoothing=None, n_sigma_threshold=5, maxwvf=0, progress=False, njob=1, compute_dtype=np.float64):
     return BatchSiPMs.BatchSiPMs(ev, SiPMPulses, nwvf_batch=nwvf_batch, convert_adc2mV=convert_adc2mV, smoothing=smoothing, n_sigma_threshold=n_sigma_threshold,
-        maxwvf=maxwvf, progress=progress, njob=njob)
+        maxwvf=maxwvf, progress=progress, njob=njob, compute_dtype=compute_dtype)
 
-def SiPMPulses(ev, convert_adc2mV=False, smoothing=None, n_sigma_threshold=5):
+def SiPMPulses(ev, convert_adc2mV=False, smoothing=None, n_sigma_threshold=5, compute_dtype=np.float64):
+    # compute_dtype: Floating point type used for the calculation. np.float32 halves the memory
+    #   of each batch, at the cost of precision in the outputs
     default = [np.nan]*32 # number of SiPMs
 
     # Stuff to save, with defaults
@@ -35,19 +38,15 @@ def SiPMPulses(ev, convert_adc2mV=False, smoothing=None, n_sigma_threshold=5):
     # Waveform in (ticks, ADC)
     traces = ev["scintillation"]["Waveforms"]
 
-    traces = traces.T.astype(float)
+    traces = traces.T.astype(compute_dtype)
 
-    # Subtract offset and convert to mV
+    # Subtract offset and scale by the range. This is the historical SiPMPulses scale,
+    # (ADC - offset)*range, which the outputs are defined in, not mV (see ADCCalibration)
     if convert_adc2mV:
-        for i_sipm in range(traces.shape[1]):
-            group = i_sipm // 8
-            chan  = i_sipm % 8
-            group_ctrl = ev["run_control"]["caen"]["group%i" % group]
-            offset = group_ctrl["offset"] + group_ctrl["ch_offset"][chan]
-            range_mV = float(group_ctrl["range"][:-4])
-
-            traces[:, i_sipm, :] -= offset
-            traces[:, i_sipm, :] *= range_mV
+        calibration = ADCCalibration.GetCalibration(ev["run_control"], traces.shape[1])
+        if calibration is None:
+            raise KeyError("convert_adc2mV needs the CAEN group settings in run_control")
+        calibration.apply(traces, axis=1, scale=calibration.range)
 
     decimation = ev["run_control"]["caen"]["global"]["decimation"]
     sample_rate =  SAMPLE_FREQ/(2**decimation)
@@ -73,35 +72,36 @@ def SiPMPulses(ev, convert_adc2mV=False, smoothing=None, n_sigma_threshold=5):
     baseline = traces[:N_SAMPLE_BASELINE].mean(axis=0)
     rms = traces[:N_SAMPLE_BASELINE].std(axis=0)
 
-    # flip the trace and correct for baseline
-    trace_V = -(traces - baseline)
+    # flip the trace and correct for baseline, in place
+    traces -= baseline
+    trace_V = np.negative(traces, out=traces)
+    del traces
+
+    # Sample index, broadcast against (sample, SiPM, trigger) arrays instead of building a full index array
+    sample_index = np.arange(trace_V.shape[0]).reshape((-1, 1, 1))
 
     # Start time of hit
     above_threshold = trace_V > rms*n_sigma_threshold
     t0_ind = np.argmax(above_threshold, axis=0)
     t0 = (t0_ind + smoothing/2) / sample_rate
 
-    # Final time of hit
-    tf_ind = np.argmax(np.cumsum(~above_threshold, axis=0) > t0_ind, axis=0)
+    # Final time of hit: first sample at or after t0 that is below threshold
+    tf_ind = np.argmax(~above_threshold & (sample_index >= t0_ind), axis=0)
     tf = (tf_ind + smoothing/2) / sample_rate
 
-    # build index into each waveform
-    wvf_index = np.zeros(trace_V.shape, dtype=np.int32)
-    wvf_index[:, :, :] = np.arange(0, wvf_index.shape[0]).reshape((wvf_index.shape[0], 1, 1))
-
-    # mask area inside hit
-    hit_trace_V = trace_V*(wvf_index >= t0_ind)*(wvf_index < tf_ind)
-
-    # voltage values
-    hit_area = hit_trace_V.sum(axis=0)
-    hit_amplitude = hit_trace_V.max(axis=0)
+    # voltage values, integrating only inside the hit
+    hit_mask = (sample_index >= t0_ind) & (sample_index < tf_ind)
+    hit_area = trace_V.sum(axis=0, where=hit_mask)
+    hit_amplitude = trace_V.max(axis=0, where=hit_mask, initial=0)
     hit_area[hit_area == 0] = np.nan
     hit_amplitude[hit_amplitude == 0] = np.nan
-    wvf_area = (trace_V*(wvf_index >= t0_ind)).sum(axis=0)
+    wvf_area = trace_V.sum(axis=0, where=sample_index >= t0_ind)
+    del hit_mask
 
-    # Are there any secondary hits after the first one?
+    # Are there any secondary hits after the first one? Compare the last sample above threshold to tf
     N_SECONDPULSE_TICK_DELAY = 10
-    second_pulse = (above_threshold*(wvf_index > (tf_ind + N_SECONDPULSE_TICK_DELAY))).any(axis=0).astype(int)
+    last_above_ind = trace_V.shape[0] - 1 - np.argmax(above_threshold[::-1], axis=0)
+    second_pulse = (above_threshold.any(axis=0) & (last_above_ind > tf_ind + N_SECONDPULSE_TICK_DELAY)).astype(int)
 
     out["baseline"] = baseline
     out["rms"] = rms
@@ -127,6 +127,9 @@ def SiPMPulses(ev, convert_adc2mV=False, smoothing=None, n_sigma_threshold=5):
 
     return out
 
+# Outputs with one row per trigger, for BatchSiPMs
+SiPMPulses.per_trigger_outputs = ("baseline", "rms", "hit_t0", "hit_tf", "hit_area", "hit_amp", "wvf_area", "second_pulse", "max_avg_fft_freq")
+
 if __name__ == "__main__":
     from GetEvent import GetEvent
 
@@ -7,27 +7,116 @@ import numpy as np
 import copy
 import numpy.matlib
 import gc
+import json
+import hashlib
+import inspect
+import argparse
+import functools
+from multiprocess import Pool
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from ana.EventAnalysis import EventAnalysis as eva
 from ana.AcousticT0 import AcousticAnalysis as aa
 from ana.ExposureAnalysis import ExposureAnalysis as expa 
+from ana.ExposureAnalysis import ExposureAnalysisRun
 from ana.SiPMPulses import SiPMPulsesBatched as sa
+from ana.SiPMPulses import SiPMPulses
 from ana.ScintRate import ScintillationRateBatched as sra
+from ana.ScintRate import ScintillationRateAnalysis
+from ana.BatchSiPMs import BatchSiPMsFused
 from ana.BubbleFinder import BubbleFinder as bf
 
-from GetEvent import GetEvent, NEvent
+from GetEvent import GetEvent, IterRun, NEvent, full_loadlist
 from sbcbinaryformat import Streamer, Writer
+from StageProfile import StageProfile
 
 ANALYSES = {
     "event": eva,
-    # "acoustic": aa,
+    "acoustic": aa,
     "exposure": expa,
     "scintillation": sa,
     "scint_rate": sra,
     "bubble": bf
 }
 
+# GetEvent subsystems (and scintillation columns) each analysis reads. Only what the
+# selected analyses need is loaded. Analyses missing here get the full loadlist.
+# cam_grayscale: the analysis only uses grayscale camera frames (see GetEvent)
+ANALYSIS_INPUTS = {
+    "event": dict(loadlist=["event_info"]),
+    "acoustic": dict(loadlist=["acoustics", "run_control"]),
+    "exposure": dict(loadlist=[]), # run level, see RUN_ANALYSES
+    "scintillation": dict(loadlist=["scintillation", "run_control"], scint_columns=["Waveforms"]),
+    "scint_rate": dict(loadlist=["scintillation", "event_info"], scint_columns=["Waveforms"]),
+    "bubble": dict(loadlist=["cam"], cam_grayscale=True),
+}
+
+def RunExposure(rundir, eventlist, **kwargs):
+    # Outputs: Dictionary of event -> ExposureAnalysis output, for the events whose event_info and slow_daq loaded
+    events, loaded, output = ExposureAnalysisRun(rundir, eventlist, **kwargs)
+    return dict([(int(ev), dict([(k, v[i]) for (k, v) in output.items()])) for (i, ev) in enumerate(events) if loaded[i]])
+
+# Analyses computed for the whole run at once, before the event loop, by a function
+# (rundir, eventlist, **parameters) -> dictionary of event -> result. Their rows are still written
+# event by event, but the event loop does not load their inputs.
+RUN_ANALYSES = {
+    "exposure": RunExposure,
+}
+
+# Run level results handed to the event workers once, at startup (see _init_event_worker)
+_run_results = {}
+
+def _init_event_worker(run_results):
+    _run_results.update(run_results)
+
+# Per-trigger scintillation kernels of the batched analyses above. When more than one of them is
+# selected, they share a single batched pass over the waveforms instead of reading them once each
+SCINT_KERNELS = {
+    "scintillation": SiPMPulses,
+    "scint_rate": ScintillationRateAnalysis,
+}
+# parameter_config keys that configure the batching rather than the kernel
+BATCH_KEYS = ["nwvf_batch", "maxwvf", "progress", "njob", "share_memory"]
+
+def RunScintKernels(data, kernels, parameter_config):
+    # Inputs:
+    #   data: Event loaded by GetEvent
+    #   kernels: Names of the SCINT_KERNELS analyses to run
+    #   parameter_config: As set up in ProcessSingleRun
+    # Outputs: Dictionary of analysis name -> result
+    ana_fs = {}
+    batch_kwargs = {}
+    for p in kernels:
+        ana_fs[p] = (SCINT_KERNELS[p], dict([(k, v) for (k, v) in parameter_config[p].items() if k not in BATCH_KEYS]))
+        batch_kwargs.update([(k, v) for (k, v) in parameter_config[p].items() if k in BATCH_KEYS])
+    return BatchSiPMsFused(data, ana_fs, **batch_kwargs)
+
+def EventLoadlist(process_list):
+    # Inputs:
+    #   process_list: List of analyses to run
+    # Outputs: (loadlist, load_kwargs) to pass to GetEvent, where load_kwargs holds
+    #   scint_columns: None if all columns are needed
+    #   cam_grayscale: True if all analyses reading the cameras only need grayscale frames
+    if any(p not in ANALYSIS_INPUTS for p in process_list):
+        return full_loadlist, dict(scint_columns=None, cam_grayscale=False)
+
+    needed = set()
+    scint_columns = set()
+    cam_grayscale = True
+    for p in process_list:
+        needed.update(ANALYSIS_INPUTS[p]["loadlist"])
+        if "scintillation" in ANALYSIS_INPUTS[p]["loadlist"]:
+            if ANALYSIS_INPUTS[p].get("scint_columns") is None:
+                scint_columns = None
+            elif scint_columns is not None:
+                scint_columns.update(ANALYSIS_INPUTS[p]["scint_columns"])
+        if "cam" in ANALYSIS_INPUTS[p]["loadlist"]:
+            cam_grayscale = cam_grayscale and ANALYSIS_INPUTS[p].get("cam_grayscale", False)
+
+    loadlist = [l for l in full_loadlist if l in needed]
+    return loadlist, dict(scint_columns=(sorted(scint_columns) if scint_columns is not None else None),
+                          cam_grayscale=cam_grayscale and "cam" in needed)
+
 def BuildEventList(rundir, maxevt=-1):
     # Inputs:
     #   rundir: Directory for the run
@@ -47,13 +136,297 @@ def dname(s):
 
     return s
 
-def ProcessSingleRun(rundir, dataset='SBC-25', recondir='.', process_list=None, maxevt=-1):
+def AnalyseEvent(data, ev, runid, process_list, parameter_config, profile=None, run_results=None):
+    # Inputs:
+    #   data: Event loaded by GetEvent. None if only RUN_ANALYSES are selected, which need no event data
+    #   ev: Event number
+    #   runid: Run ID array saved with each result
+    #   process_list, parameter_config: As set up in ProcessSingleRun
+    #   profile: StageProfile to record the cost of each analysis in
+    #   run_results: Results of the RUN_ANALYSES by analysis name and event, computed before the event loop
+    # Outputs: A list of (analysis name, result) pairs, in process_list order, for the analyses that ran
+    if profile is None:
+        profile = StageProfile()
+    if run_results is None:
+        run_results = {}
+    results = []
+    npev = np.array([ev], dtype=np.int32)
+
+    # Run the selected scintillation kernels together, reading each waveform batch only once
+    fused = {}
+    kernels = [p for p in process_list if p in SCINT_KERNELS]
+    if len(kernels) > 1 and data["scintillation"]["loaded"]:
+        try:
+            with profile.stage("scint_fused", ev):
+                fused = RunScintKernels(data, kernels, parameter_config)
+        except Exception as e:
+            print("Fused analyses %s failed on event %i with error: %s. Running them separately." % (", ".join(kernels), ev, str(e)))
+            fused = {}
+
+    for p in process_list:
+        t1 = time.time()
+
+        # Run level analyses were done up front
+        if p in run_results:
+            if int(ev) not in run_results[p]:
+                print(f"Skipping {p} analysis -- no run level result for this event.")
+                continue
+            result = dict(run_results[p][int(ev)])
+            result['runid'] = runid
+            result['ev'] = npev
+            results.append((p, result))
+            continue
+
+        # Skip analysis if data not loaded
+        if (p == "scint_rate" or p == "scintillation") and not data["scintillation"]["loaded"]:
+            print(f"Skipping {p} analysis -- scintillation data not loaded.")
+            continue
+        elif p == "exposure" and not (data["event_info"]["loaded"] and data["slow_daq"]["loaded"]):
+            print(f"Skipping {p} analysis -- event info data not loaded.")
+            continue
+        elif p == "acoustic" and not data["acoustics"]["loaded"]:
+            print(f"Skipping {p} analysis -- acoustic data not loaded.")
+            continue
+        elif p == "event" and not data["event_info"]["loaded"]:
+            print(f"Skipping {p} analysis -- event info data not loaded.")
+            continue
+
+        try:
+            with profile.stage(p, ev):
+                result = fused[p] if p in fused else ANALYSES[p](data, **parameter_config[p])
+        except Exception as e:
+            print("Analysis %s failed on event %i with error: %s" % (p, ev, str(e)))
+            continue
+        result['runid'] = runid
+        result['ev'] = npev
+        results.append((p, result))
+
+        et = time.time() - t1
+        print(('%s analysis:  ' % p).rjust(35) + f"{et:.6f} seconds")
+
+    return results
+
+def LoadAndAnalyseEvent(ev, rundir, runid, process_list, parameter_config, loadlist=(), load_kwargs=None):
+    # Process pool entry point: load a single event and run the analyses on it.
+    # Run level results come from the pool initializer, _init_event_worker
+    # Outputs: (ev, results, profile rows), where results is None if the event failed to load
+    if load_kwargs is None:
+        load_kwargs = {}  # not a mutable default, see ProcessSingleRun
+    t0 = time.time()
+    profile = StageProfile()
+    runname = os.path.basename(rundir).split(".")[0]
+    print('Starting event ' + runname + '/' + str(ev))
+
+    try:
+        data = GetEvent(rundir, ev, *loadlist, strictMode=False, profile=profile, **load_kwargs)
+    except Exception as e:
+        print(f"Failed to load event {ev} with error: {e}. Skipping event.")
+        return ev, None, profile.rows
+
+    print('Time to load event:  '.rjust(35) + f"{time.time()-t0:.6f} seconds")
+    results = AnalyseEvent(data, ev, runid, process_list, parameter_config, profile=profile, run_results=_run_results)
+
+    del data
+    gc.collect()
+
+    print('*** Full event analysis ***  '.rjust(35) + f"{time.time()-t0:.6f} seconds\n")
+    return ev, results, profile.rows
+
+def WriteResults(writers, results, run_recondir):
+    # Inputs:
+    #   writers: Dictionary of open Writers by analysis name. Writers are created here on first use
+    #   results: Output of AnalyseEvent for one event
+    #   run_recondir: Directory to write the binary files to
+    for p, result in results:
+        # create writer if it doesn't exist
+        if p not in writers:
+            column_names = list(result.keys())
+            dtypes = []
+            sizes = []
+            
+            for c in column_names:
+                val = result[c]
+                if not isinstance(val, np.ndarray):
+                    val = np.array(val)
+                dtypes.append(dname(val.dtype.str))
+                
+                if p == "scint_rate" or p == "bubble":
+                    shape = list(np.atleast_1d(val).shape)
+                else:
+                    shape = list(np.squeeze(val).shape)
+                shape = shape if len(shape) else [1]
+                shape = shape[1:] if len(shape) > 1 else shape
+                sizes.append(shape)
+            
+            writers[p] = Writer(os.path.join(run_recondir, f"{p}.sbc"), column_names, dtypes, sizes)
+
+        # Write to file
+        column_names = list(result.keys())
+        writers[p].write(dict([(c, np.squeeze(result[c])) for c in column_names]))
+
+# Checkpoint manifest kept in the output directory. Records the last event whose results were handed
+# to the writers, overall and per analysis, so an interrupted run can be resumed with --resume. It also
+# holds a fingerprint of each finished analysis output, so that reruns skip analyses that are up to date
+CHECKPOINT_NAME = "checkpoint.json"
+RESUME_CHUNK = 10000 # rows copied at a time when resuming
+
+def ReadCheckpoint(run_recondir):
+    try:
+        with open(os.path.join(run_recondir, CHECKPOINT_NAME), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def WriteCheckpoint(run_recondir, checkpoint):
+    path = os.path.join(run_recondir, CHECKPOINT_NAME)
+    with open(path + ".tmp", "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(path + ".tmp", path) # atomic, so an eviction never leaves a half-written manifest
+
+def RecordEvent(run_recondir, checkpoint, ev, results):
+    # Update the checkpoint after the results of event ev were written
+    checkpoint["last_event"] = int(ev)
+    for p, _ in results:
+        checkpoint["analyses"][p] = int(ev)
+    WriteCheckpoint(run_recondir, checkpoint)
+
+def NewCheckpoint(fingerprints=None):
+    return dict(last_event=-1, analyses={}, fingerprints=dict(fingerprints or {}))
+
+def InputStats(rundir):
+    # Outputs: A list of (file name, size, mtime) for the raw data files of a run
+    if not os.path.isdir(rundir):
+        stat = os.stat(rundir)
+        return [[os.path.basename(rundir), stat.st_size, stat.st_mtime_ns]]
+    stats = []
+    for dirpath, dirnames, filenames in os.walk(rundir):
+        dirnames.sort()
+        for fname in sorted(filenames):
+            stat = os.stat(os.path.join(dirpath, fname))
+            stats.append([os.path.relpath(os.path.join(dirpath, fname), rundir), stat.st_size, stat.st_mtime_ns])
+    return stats
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def AnalysisSources(p):
+    # Outputs: Sorted source files the output of analysis p depends on. These are its module, every module
+    #          of this repository it uses (directly or through other modules, e.g. BatchSiPMs, ADCCalibration,
+    #          GetEvent), and this file, which loads the events, runs the fused and run level paths and writes
+    sources = set([os.path.abspath(__file__), os.path.join(REPO_DIR, "GetEvent.py")])
+    todo = [inspect.getmodule(ANALYSES[p])]
+    seen = set()
+    while todo:
+        mod = todo.pop()
+        if mod is None or mod.__name__ in seen:
+            continue
+        seen.add(mod.__name__)
+        fname = getattr(mod, "__file__", None)
+        if fname is None or not os.path.abspath(fname).startswith(REPO_DIR + os.sep):
+            continue
+        sources.add(os.path.abspath(fname))
+        for val in list(vars(mod).values()):
+            todo.append(val if inspect.ismodule(val) else inspect.getmodule(val))
+    return sorted(sources)
+
+def AnalysisFingerprint(p, parameter_config, input_stats, eventlist):
+    # Inputs:
+    #   p: Analysis name
+    #   parameter_config: Keyword arguments passed to the analysis
+    #   input_stats: Output of InputStats for the run
+    #   eventlist: Events being processed
+    # Outputs: A hash of the analysis sources (see AnalysisSources), its parameters and the raw input files.
+    #          If it matches the fingerprint stored with an output, the output is up to date.
+    h = hashlib.sha1()
+    for source in AnalysisSources(p):
+        h.update(os.path.relpath(source, REPO_DIR).encode())
+        with open(source, "rb") as f:
+            h.update(f.read())
+    h.update(json.dumps(parameter_config, sort_keys=True, default=repr).encode())
+    h.update(json.dumps(input_stats).encode())
+    h.update(np.asarray(eventlist, dtype=np.int64).tobytes())
+    return h.hexdigest()
+
+def ResumeOutputs(run_recondir, process_list, checkpoint, fingerprints):
+    # Inputs:
+    #   run_recondir: Output directory of the interrupted run
+    #   process_list: List of analyses being run
+    #   checkpoint: Checkpoint read from run_recondir, or None
+    #   fingerprints: Dictionary of analysis -> AnalysisFingerprint for this run
+    # Outputs: (writers, checkpoint, dictionary of analysis -> first event to process)
+    # The rows of the last event handed to the writers (checkpoint["last_event"]) may not have been flushed
+    # to disk when the job was killed, so processing continues from that event. Outputs are trimmed to the
+    # rows of the events before it and reopened for writing.
+    # Analyses whose fingerprint differs from the one the interrupted run was writing with (see "pending"
+    # in the checkpoint) lose their partial output and start again from the first event.
+    if checkpoint is None:
+        print("No checkpoint found in %s. Starting from the first event." % run_recondir)
+        return {}, NewCheckpoint(), dict([(p, 0) for p in process_list])
+
+    first_events = {}
+    pending = checkpoint.get("pending", {})
+    for p in process_list:
+        if pending.get(p) != fingerprints[p]:
+            print("%s changed since the interrupted run (code, parameters or raw data). Restarting it from the first event." % p)
+            first_events[p] = 0
+            checkpoint["analyses"].pop(p, None)
+            if os.path.exists(os.path.join(run_recondir, f"{p}.sbc")):
+                os.remove(os.path.join(run_recondir, f"{p}.sbc"))
+
+    first_ev = max(checkpoint["last_event"], 0)
+    outputs = {}
+    for p in process_list:
+        fname = os.path.join(run_recondir, f"{p}.sbc")
+        if p in first_events or p not in checkpoint["analyses"] or not os.path.exists(fname):
+            continue
+        try:
+            streamer = Streamer(fname)
+            evs = np.concatenate([np.ravel(streamer.to_dict(start=start, end=min(start + RESUME_CHUNK, streamer.num_elems))["ev"])
+                                  for start in range(0, streamer.num_elems, RESUME_CHUNK)] + [np.array([], dtype=np.int32)])
+        except Exception as e:
+            print("Could not read %s with error: %s. Starting from the first event." % (fname, str(e)))
+            return {}, NewCheckpoint(checkpoint.get("fingerprints")), dict([(p, 0) for p in process_list])
+        outputs[p] = (fname, evs)
+
+    # Rewrite the finished rows of each output, then keep its writer open for the remaining events
+    writers = {}
+    for p, (fname, evs) in outputs.items():
+        nkeep = int(np.sum(evs < first_ev))
+        os.replace(fname, fname + ".resume")
+        streamer = Streamer(fname + ".resume")
+        for start in range(0, nkeep, RESUME_CHUNK):
+            rows = streamer.to_dict(start=start, end=min(start + RESUME_CHUNK, nkeep))
+            if p not in writers:
+                column_names = list(rows.keys())
+                dtypes = [dname(rows[c].dtype.str) for c in column_names]
+                sizes = [list(rows[c].shape[1:]) or [1] for c in column_names]
+                writers[p] = Writer(fname, column_names, dtypes, sizes)
+            writers[p].write(rows)
+        del streamer
+        os.remove(fname + ".resume")
+        print("Resuming %s output with %i rows kept." % (p, nkeep))
+
+    checkpoint["last_event"] = first_ev - 1
+    checkpoint["analyses"] = dict([(p, min(ev, first_ev - 1)) for (p, ev) in checkpoint["analyses"].items()])
+    for p in process_list:
+        first_events.setdefault(p, first_ev)
+    return writers, checkpoint, first_events
+
+def ResumedResults(results, ev, first_events):
+    # When some analyses were restarted on resume, the events before the resume point are run again for them.
+    # Drop the results of the other analyses for those events, since their rows were kept
+    return [(p, result) for (p, result) in results if ev >= first_events.get(p, 0)]
+
+def ProcessSingleRun(rundir, dataset='SBC-25', recondir='.', process_list=None, maxevt=-1, prefetch=2, workers=1, resume=False, force=False):
     # Inputs:
     #   rundir: Location of raw data
     #   dataset: Indicator used for filtering which analyses to run
     #   recondir: Location of recon data/where we want to output our binary files
     #   process_list: List of analyses modules to run. example: ["acoustic", "event", ""]
     #   maxevt: Maximum number of events to process
+    #   prefetch: Number of events to load in the background while the current one is analysed (0 to disable)
+    #   workers: Number of processes to analyse events on. Outputs are written in event order either way
+    #   resume: If True, continue an interrupted run from the checkpoint in recondir instead of starting over
+    #   force: If True, rerun every analysis, even ones whose output is already up to date
     # Outputs: Nothing. Saves binary files to recondir.
     if process_list is None:
         process_list = []  # This is needed since lists are mutable objects. If you have a default argument
@@ -95,97 +468,157 @@ def ProcessSingleRun(rundir, dataset='SBC-25', recondir='.', process_list=None,
     print("Starting run " + rundir)
     eventlist = BuildEventList(rundir, maxevt=maxevt)
 
-    # Create writers before event loop
-    writers = {}
+    # Skip analyses whose output was made from the same code, parameters and raw data
+    checkpoint = ReadCheckpoint(run_recondir)
+    fingerprints = dict(checkpoint.get("fingerprints", {})) if checkpoint is not None else {}
+    input_stats = InputStats(rundir)
+    new_fingerprints = dict([(p, AnalysisFingerprint(p, parameter_config[p], input_stats, eventlist)) for p in process_list])
+    if not force:
+        up_to_date = [p for p in process_list if fingerprints.get(p) == new_fingerprints[p]
+                      and os.path.exists(os.path.join(run_recondir, f"{p}.sbc"))]
+        if up_to_date:
+            print("Skipping up-to-date analyses: " + ", ".join(up_to_date))
+        process_list = [p for p in process_list if p not in up_to_date]
+    if len(process_list) == 0:
+        print("All analyses are up to date.")
+        return
 
-    for ev in eventlist:
-        t0 = time.time()
-        print('Starting event ' + runname + '/' + str(ev))
+    # outputs being regenerated are no longer up to date until the run finishes
+    for p in process_list:
+        fingerprints.pop(p, None)
+    if checkpoint is not None:
+        checkpoint["fingerprints"] = fingerprints
 
-        try:
-            data = GetEvent(rundir, ev, strictMode=False)
-        except Exception as e:
-            print(f"Failed to load event {ev} with error: {e}. Skipping event.")
-            continue
+    # Only load the subsystems the selected analyses use
+    loadlist, load_kwargs = EventLoadlist(process_list)
+    if loadlist:
+        print("Loading: " + ", ".join(loadlist))
 
-        print('Time to load event:  '.rjust(35) + f"{time.time()-t0:.6f} seconds")
-        npev = np.array([ev], dtype=np.int32)
+    # Per-stage timing and memory, saved next to the outputs at the end of the run
+    profile = StageProfile()
 
+    # Create writers before event loop
+    if resume:
+        writers, checkpoint, first_events = ResumeOutputs(run_recondir, process_list, checkpoint, new_fingerprints)
+        first_ev = min(first_events.values())
+        eventlist = eventlist[eventlist >= first_ev]
+        print("Resuming from event %i" % first_ev)
+    else:
+        writers = {}
+        first_events = {}
+        checkpoint = NewCheckpoint(fingerprints)
+        # remove stale outputs so they are regenerated from scratch
         for p in process_list:
-            t1 = time.time()
+            if os.path.exists(os.path.join(run_recondir, f"{p}.sbc")):
+                os.remove(os.path.join(run_recondir, f"{p}.sbc"))
+    checkpoint["rundir"] = rundir
+    checkpoint["process_list"] = process_list
+    # the fingerprints the outputs are being written with, so that --resume can tell whether the partial
+    # outputs of an interrupted run still match the code, parameters and raw data
+    checkpoint["pending"] = dict([(p, new_fingerprints[p]) for p in process_list])
+    WriteCheckpoint(run_recondir, checkpoint)
 
-            # Skip analysis if data not loaded
-            if (p == "scint_rate" or p == "scintillation") and not data["scintillation"]["loaded"]:
-                print(f"Skipping {p} analysis -- scintillation data not loaded.")
-                continue
-            elif p == "exposure" and not (data["event_info"]["loaded"] and data["slow_daq"]["loaded"]):
-                print(f"Skipping {p} analysis -- event info data not loaded.")
-                continue
-            elif p == "acoustic" and not data["acoustic"]["loaded"]:
-                print(f"Skipping {p} analysis -- acoustic data not loaded.")
-                continue
-            elif p == "event" and not data["event_info"]["loaded"]:
-                print(f"Skipping {p} analysis -- event info data not loaded.")
-                continue
+    # Analyses of the whole run at once, before the event loop
+    run_results = {}
+    for p in process_list:
+        if p not in RUN_ANALYSES:
+            continue
+        t1 = time.time()
+        try:
+            with profile.stage(p):
+                run_results[p] = RUN_ANALYSES[p](rundir, eventlist, **parameter_config[p])
+        except Exception as e:
+            print("Run level analysis %s failed with error: %s" % (p, str(e)))
+            run_results[p] = {}
+        print(('%s analysis (run):  ' % p).rjust(35) + f"{time.time()-t1:.6f} seconds")
 
-            try:
-                result = ANALYSES[p](data, **parameter_config[p])
-            except Exception as e:
-                print("Analysis %s failed on event %i with error: %s" % (p, ev, str(e)))
-                continue
-            result['runid'] = runid
-            result['ev'] = npev
-            
-            # create writer if it doesn't exist
-            if p not in writers:
-                column_names = list(result.keys())
-                dtypes = []
-                sizes = []
-                
-                for c in column_names:
-                    val = result[c]
-                    if not isinstance(val, np.ndarray):
-                        val = np.array(val)
-                    dtypes.append(dname(val.dtype.str))
-                    
-                    if p == "scint_rate" or p == "bubble":
-                        shape = list(np.atleast_1d(val).shape)
-                    else:
-                        shape = list(np.squeeze(val).shape)
-                    shape = shape if len(shape) else [1]
-                    shape = shape[1:] if len(shape) > 1 else shape
-                    sizes.append(shape)
-                
-                writers[p] = Writer(os.path.join(run_recondir, f"{p}.sbc"), column_names, dtypes, sizes)
+    if all(p in RUN_ANALYSES for p in process_list):
+        # Only run level analyses are left, and their results are in hand: write them without loading
+        # any events (GetEvent would load every subsystem for an empty loadlist)
+        for ev in eventlist:
+            results = AnalyseEvent(None, ev, runid, process_list, parameter_config, profile=profile, run_results=run_results)
+            results = ResumedResults(results, ev, first_events)
+            with profile.stage("write", ev):
+                WriteResults(writers, results, run_recondir)
+                RecordEvent(run_recondir, checkpoint, ev, results)
+            del results
+    elif workers > 1:
+        # Events are analysed out of process, but imap hands back the results in event order,
+        # so the writers see exactly the same sequence of rows as in a serial run
+        worker = functools.partial(LoadAndAnalyseEvent, rundir=rundir, runid=runid,
+                                   process_list=process_list, parameter_config=parameter_config,
+                                   loadlist=loadlist, load_kwargs=load_kwargs)
+        with Pool(processes=workers, initializer=_init_event_worker, initargs=(run_results,)) as pool:
+            for ev, results, profile_rows in pool.imap(worker, eventlist):
+                profile.extend(profile_rows)
+                if results is None:
+                    continue
+                results = ResumedResults(results, ev, first_events)
+                with profile.stage("write", ev):
+                    WriteResults(writers, results, run_recondir)
+                    RecordEvent(run_recondir, checkpoint, ev, results)
+                del results
+    else:
+        t0 = time.time()
+        for ev, data in IterRun(rundir, *loadlist, events=eventlist, prefetch=prefetch, strictMode=False,
+                                skip_errors=True, profile=profile, **load_kwargs):
+            print('Starting event ' + runname + '/' + str(ev))
 
-            # Write to file
-            column_names = list(result.keys())
-            writers[p].write(dict([(c, np.squeeze(result[c])) for c in column_names]))
-            del result
+            # with prefetching, this is the time spent waiting on the loader
+            print('Time to load event:  '.rjust(35) + f"{time.time()-t0:.6f} seconds")
+
+            results = AnalyseEvent(data, ev, runid, process_list, parameter_config, profile=profile, run_results=run_results)
+            results = ResumedResults(results, ev, first_events)
+            with profile.stage("write", ev):
+                WriteResults(writers, results, run_recondir)
+                RecordEvent(run_recondir, checkpoint, ev, results)
+            del results
             
-            et = time.time() - t1
-            print(('%s analysis:  ' % p).rjust(35) + f"{et:.6f} seconds")
-        
-        del data
-        gc.collect()
+            del data
+            gc.collect()
 
-        print('*** Full event analysis ***  '.rjust(35) + f"{time.time()-t0:.6f} seconds\n")
+            print('*** Full event analysis ***  '.rjust(35) + f"{time.time()-t0:.6f} seconds\n")
+            t0 = time.time()
 
     # delete all writers
+    with profile.stage("close_writers"):
+        for p in process_list:
+            if p in writers:
+                del writers[p]
+
+    # mark the outputs of this run as up to date
     for p in process_list:
-        if p in writers:
-            del writers[p]
+        checkpoint["fingerprints"][p] = new_fingerprints[p]
+    checkpoint.pop("pending", None)
+    WriteCheckpoint(run_recondir, checkpoint)
+
+    profile.write(os.path.join(run_recondir, "profile"))
+    print("Stage profile (also saved to %s):" % os.path.join(run_recondir, "profile.json"))
+    profile.print_summary()
     
     return
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1:
+    parser = argparse.ArgumentParser(description="Run the event-level analyses over a single run")
+    parser.add_argument("rundir", nargs="?", help="Location of raw data (directory or .tar)")
+    parser.add_argument("recondir", nargs="?", help="Directory to write the output binary files to")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes to analyse events on")
+    parser.add_argument("--prefetch", type=int, default=2, help="Events to load ahead of the analysis (serial mode only)")
+    parser.add_argument("--resume", action="store_true", help="Continue an interrupted run from the checkpoint in recondir")
+    parser.add_argument("--force", action="store_true", help="Rerun every analysis, even ones whose output is up to date")
+    args = parser.parse_args()
+
+    if args.rundir is not None:
         ProcessSingleRun(
-            rundir=sys.argv[1],
-            recondir=sys.argv[2],
-            process_list = ["event", "exposure", "scintillation", "scint_rate", "bubble"])
+            rundir=args.rundir,
+            recondir=args.recondir,
+            process_list = ["event", "exposure", "scintillation", "scint_rate", "bubble"],
+            prefetch=args.prefetch,
+            workers=args.workers,
+            resume=args.resume,
+            force=args.force)
     else:
         ProcessSingleRun(
             rundir="/exp/e961/data/SBC-25-daqdata/20260221_0.tar",
             recondir="/home/zsheng/test", # Use your own directory for testing~
-            process_list = ["event", "bubble"])
\ No newline at end of file
+            process_list = ["event", "bubble"])